@@ -0,0 +1,262 @@
+"""قياس أداء معالجات البوت دون الاتصال بـ Telegram"""
+# python bench.py --users 20000 --content 5000 --updates 2000 --concurrency 32
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+
+ADMIN_ID = 1
+TOKEN = '123456:BENCH'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='قياس أداء معالجات البوت مع Bot API وهمي')
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'bench_content_bot.db'),
+                        help='ملف قاعدة البيانات التجريبية (لا تستخدم content_bot.db الحقيقية)')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--content', type=int, default=2000)
+    parser.add_argument('--updates', type=int, default=1000, help='عدد التحديثات لكل سيناريو')
+    parser.add_argument('--concurrency', type=int, default=16, help='عدد المستخدمين المتزامنين')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='تأخير كل طلب Bot API بالمللي ثانية')
+    parser.add_argument('--port', type=int, default=18081)
+    parser.add_argument('--scenarios', default='start,categories,category,recent,content,page,search,broadcast')
+    parser.add_argument('--keep', action='store_true', help='إعادة استخدام قاعدة البيانات إن وجدت')
+    return parser.parse_args()
+
+args = parse_args()
+if not args.keep and os.path.exists(args.db):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+
+# يجب ضبط البيئة قبل استيراد البوت لأنه يفتح قاعدة البيانات عند الاستيراد
+os.environ['DB_PATH'] = args.db
+os.environ['ADMIN_ID'] = str(ADMIN_ID)
+os.environ.setdefault('TELEGRAM_RATE_LIMIT', '100000')
+os.environ.setdefault('BROADCAST_CONCURRENCY', '50')
+
+import logging
+import tornado.httpserver
+import tornado.web
+from telegram import Update
+
+import bot
+
+logging.getLogger().setLevel(logging.WARNING)
+
+class FakeBotAPI(tornado.web.RequestHandler):
+    """يرد على كل طريقة في Bot API بنتيجة صالحة بأقل قدر من العمل"""
+
+    message_id = 0
+
+    async def post(self, bot_method):
+        if args.api_latency:
+            await asyncio.sleep(args.api_latency / 1000)
+        chat_id = self.get_body_argument('chat_id', None)
+        if bot_method == 'getMe':
+            result = {'id': 999, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif bot_method == 'getChatMember':
+            user_id = int(self.get_body_argument('user_id', 0))
+            result = {'status': 'member', 'user': {'id': user_id, 'is_bot': False, 'first_name': 'u'}}
+        elif bot_method in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook', 'deleteMessage'):
+            result = True
+        else:
+            FakeBotAPI.message_id += 1
+            result = {
+                'message_id': FakeBotAPI.message_id, 'date': int(time.time()),
+                'chat': {'id': int(chat_id or 0), 'type': 'private'}, 'text': '',
+            }
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'ok': True, 'result': result}))
+
+    get = post
+
+    def log_exception(self, *exc_info):
+        pass
+
+def seed(database):
+    """ملء قاعدة البيانات مباشرة بـ executemany، ويُتخطى إذا كانت مملوءة من قبل"""
+    conn = database.conn
+    if conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] > 1:
+        return
+    started = time.perf_counter()
+    conn.executemany(
+        'INSERT OR IGNORE INTO users (user_id, username, first_name, is_approved, has_subscribed) VALUES (?, ?, ?, 1, 1)',
+        ((user_id, f'user{user_id}', f'مستخدم {user_id}') for user_id in range(1000, 1000 + args.users))
+    )
+    conn.executemany('INSERT INTO categories (name) VALUES (?)', ((f'قسم {i}',) for i in range(args.categories)))
+    category_ids = [row[0] for row in conn.execute('SELECT id FROM categories')]
+    words = ['قصة', 'الأميرة', 'مغامرة', 'البحر', 'مدرسة', 'حكاية', 'الغابة', 'صديق', 'رحلة', 'الكنز']
+    conn.executemany(
+        'INSERT INTO content (title, content, content_type, category_id, created_date) VALUES (?, ?, ?, ?, ?)',
+        ((
+            f'{random.choice(words)} {i}',
+            ' '.join(random.choices(words, k=40)),
+            'text',
+            category_ids[i % len(category_ids)],
+            f'2024-01-01 00:00:{i % 60:02d}',
+        ) for i in range(args.content))
+    )
+    conn.commit()
+    database.reload_categories()
+    print(f"🌱 تم ملء قاعدة البيانات في {time.perf_counter() - started:.1f}s")
+
+_update_id = [0]
+
+def message_update(user_id, text):
+    _update_id[0] += 1
+    message = {
+        'message_id': _update_id[0], 'date': int(time.time()), 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u', 'username': f'user{user_id}'},
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': _update_id[0], 'message': message}
+
+def callback_update(user_id, data):
+    _update_id[0] += 1
+    return {'update_id': _update_id[0], 'callback_query': {
+        'id': str(_update_id[0]), 'chat_instance': 'bench', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'text': '-'},
+    }}
+
+def scenario_updates(name, count):
+    """قائمة (معرف المستخدم، قائمة التحديثات التي تُرسل بالترتيب) لكل تحديث مقاس"""
+    categories = bot.db.get_categories()
+    content_ids = [row[0] for row in bot.db.conn.execute('SELECT id FROM content ORDER BY RANDOM() LIMIT 200')]
+    first_page, _, _ = bot.db.get_content_page(categories[0].id, limit=bot.CONTENT_PAGE_SIZE) if categories else ([], 0, 0)
+    items = []
+    for i in range(count):
+        user_id = 1000 + i % max(args.users, 1)
+        if name == 'start':
+            updates = [message_update(user_id, '/start')]
+        elif name == 'categories':
+            updates = [message_update(user_id, '📁 الاقسام')]
+        elif name == 'category':
+            updates = [message_update(user_id, categories[i % len(categories)].name)]
+        elif name == 'recent':
+            updates = [message_update(user_id, '📚 آخر القصص')]
+        elif name == 'content':
+            updates = [callback_update(user_id, f'content_{content_ids[i % len(content_ids)]}')]
+        elif name == 'page':
+            last = first_page[-1]
+            updates = [callback_update(user_id, f'cpage_{categories[0].id}_n_{last.id}_{last.created_date}')]
+        elif name == 'search':
+            updates = [message_update(user_id, '🔎 بحث'), message_update(user_id, random.choice(['اميرة', 'البحر رحلة', 'كنز']))]
+        else:
+            raise ValueError(name)
+        items.append((user_id, updates))
+    return items
+
+class StatementCounter:
+    """عداد عبارات SQL على اتصال الكتابة وكل اتصالات القراءة"""
+    # لا تُحسب عبارات المشغلات ولا BEGIN و COMMIT
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, statement):
+        if statement.startswith('--') or statement.split(None, 1)[0].upper() in ('BEGIN', 'COMMIT', 'ROLLBACK'):
+            return
+        with self._lock:
+            self.count += 1
+
+    def install(self, database):
+        database._conn.set_trace_callback(self)
+        connect = database.connect
+
+        def traced_connect():
+            conn = connect()
+            conn.set_trace_callback(self)
+            return conn
+
+        # اتصالات القراءة تُفتح عند أول استعلام في كل خيط، أي بعد هذا الاستبدال
+        database.connect = traced_connect
+
+statements = StatementCounter()
+statements.install(bot.db)
+
+def db_query_count():
+    return statements.count
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+async def run_scenario(application, name):
+    items = scenario_updates(name, args.updates)
+    by_user = {}
+    for user_id, updates in items:
+        by_user.setdefault(user_id, []).append(updates)
+    # كل عامل يأخذ مستخدمين كاملين حتى يبقى ترتيب تحديثات المستخدم الواحد كما في الإنتاج
+    user_queue = asyncio.Queue()
+    for user_updates in by_user.values():
+        user_queue.put_nowait(user_updates)
+    latencies = []
+
+    async def worker():
+        while not user_queue.empty():
+            for updates in user_queue.get_nowait():
+                started = time.perf_counter()
+                for update in updates:
+                    await application.process_update(Update.de_json(update, application.bot))
+                latencies.append(time.perf_counter() - started)
+
+    queries_before = db_query_count()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    queries = db_query_count() - queries_before
+    return len(latencies), elapsed, latencies, queries
+
+async def run_broadcast(application):
+    """زمن إيصال بث واحد لكل المستخدمين عبر محرك البث الحقيقي"""
+    queries_before = db_query_count()
+    started = time.perf_counter()
+    await application.process_update(Update.de_json(message_update(ADMIN_ID, '📢 البث الجماعي'), application.bot))
+    await application.process_update(Update.de_json(message_update(ADMIN_ID, 'رسالة تجريبية'), application.bot))
+    while bot.background_tasks:
+        await asyncio.gather(*list(bot.background_tasks), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    broadcast_id = bot.db.conn.execute('SELECT MAX(id) FROM broadcasts').fetchone()[0]
+    counts = bot.db.get_broadcast_counts(broadcast_id)
+    return sum(counts.values()), elapsed, db_query_count() - queries_before
+
+async def main():
+    seed(bot.db)
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(r'/bot[^/]+/(\w+)', FakeBotAPI)]))
+    server.listen(args.port, address='127.0.0.1')
+    application = bot.build_application(TOKEN, base_url=f'http://127.0.0.1:{args.port}/bot')
+    await application.initialize()
+
+    print(f"👥 {args.users} مستخدم | 📁 {args.categories} قسم | 📦 {args.content} محتوى | "
+          f"⚡ {args.concurrency} متزامن | 🌐 تأخير API {args.api_latency}ms")
+    print(f"{'السيناريو':<12}{'التحديثات':>10}{'تحديث/ث':>10}{'p50 ms':>10}{'p99 ms':>10}{'SQL/تحديث':>16}")
+    for name in args.scenarios.split(','):
+        if name == 'broadcast':
+            delivered, elapsed, queries = await run_broadcast(application)
+            print(f"{name:<12}{delivered:>10}{delivered / elapsed:>10.0f}{'-':>10}{'-':>10}"
+                  f"{queries / max(delivered, 1):>16.2f}")
+            continue
+        count, elapsed, latencies, queries = await run_scenario(application, name)
+        print(f"{name:<12}{count:>10}{count / elapsed:>10.0f}"
+              f"{percentile(latencies, 0.5) * 1000:>10.2f}{percentile(latencies, 0.99) * 1000:>10.2f}"
+              f"{queries / max(count, 1):>16.2f}")
+
+    errors = {label: value for (metric, label), value in bot.metrics.counters.items() if metric == 'bot_handler_errors_total'}
+    if errors:
+        print(f"❌ أخطاء في المعالجات: {errors}")
+    await application.shutdown()
+    server.stop()
+    await bot.adb.flush_activity()
+    bot.adb.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
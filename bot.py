@@ -1,13 +1,27 @@
 import os
+import re
 import logging
 import sqlite3
 import json
 import zipfile
 import io
 import tempfile
+import asyncio
+import functools
+import itertools
+import signal
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import tornado.httpserver
+import tornado.web
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, PersistenceInput, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
 
 # إعداد التسجيل
 logging.basicConfig(
@@ -16,14 +30,673 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class Database:
+class ActivityBuffer:
+    """تجميع تحديثات آخر نشاط للمستخدمين في الذاكرة لكتابتها دفعة واحدة"""
+
+    def __init__(self, interval=30, max_pending=500):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._inflight = {}
+        self._last_flush = time.monotonic()
+
+    def touch(self, user_id):
+        # نفس صيغة CURRENT_TIMESTAMP في SQLite
+        stamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            self._pending[user_id] = stamp
+
+    def due(self):
+        with self._lock:
+            if not self._pending:
+                return False
+            return (len(self._pending) >= self.max_pending
+                    or time.monotonic() - self._last_flush >= self.interval)
+
+    def drain(self):
+        with self._lock:
+            self._inflight, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            return dict(self._inflight)
+
+    def done(self, failed=False):
+        with self._lock:
+            if failed:
+                # إعادة القيم التي لم تُكتب دون الكتابة فوق نشاط أحدث
+                for user_id, stamp in self._inflight.items():
+                    self._pending.setdefault(user_id, stamp)
+            self._inflight = {}
+
+    def snapshot(self):
+        with self._lock:
+            merged = dict(self._inflight)
+            merged.update(self._pending)
+            return merged
+
+class ViewCounter:
+    """عداد مشاهدات المحتوى في الذاكرة، ويُكتب مع دورة حفظ النشاط"""
+
+    def __init__(self, interval=30):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+
+    def add(self, content_id):
+        with self._lock:
+            self._pending[content_id] = self._pending.get(content_id, 0) + 1
+
+    def due(self):
+        with self._lock:
+            return bool(self._pending) and time.monotonic() - self._last_flush >= self.interval
+
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            return pending
+
+    def restore(self, counts):
+        with self._lock:
+            for content_id, views in counts.items():
+                self._pending[content_id] = self._pending.get(content_id, 0) + views
+
+class TimedCache:
+    """قيم محسوبة تبقى صالحة لمدة ttl ثانية"""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1], True
+        self.misses += 1
+        return None, False
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def clear(self):
+        self._entries = {}
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+class SettingsCache:
+    """نسخة من جدول bot_settings في الذاكرة تُستبدل كاملة عند كل تحديث"""
+
     def __init__(self):
-        self.conn = sqlite3.connect('content_bot.db', check_same_thread=False)
+        self._values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, rows):
+        self._values = dict(rows)
+
+    def get(self, key):
+        values = self._values
+        if key in values:
+            self.hits += 1
+            return values[key], True
+        self.misses += 1
+        return None, False
+
+    def set(self, key, value):
+        values = dict(self._values)
+        values[key] = value
+        self._values = values
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._values)}
+
+class CategoryIndex:
+    """فهرس الأقسام في الذاكرة: الاسم ← المعرف، والمعرف ← الصف"""
+
+    def __init__(self):
+        self._rows = []
+        self._by_id = {}
+        self._by_name = {}
+
+    def load(self, rows):
+        rows = list(rows)
+        # استبدال الفهرس كاملاً دفعة واحدة حتى لا يرى القارئ حالة ناقصة
+        self._rows, self._by_id, self._by_name = (
+            rows, {row.id: row for row in rows}, {row.name: row.id for row in rows}
+        )
+
+    def all(self):
+        return list(self._rows)
+
+    def get(self, category_id):
+        return self._by_id.get(category_id)
+
+    def id_for(self, name):
+        return self._by_name.get(name)
+
+class MarkupCache:
+    """لوحات المفاتيح المبنية مسبقاً، وكل مدخل صالح فقط لنسخة الكتالوج التي بُني عليها"""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], True
+            self.misses += 1
+            return None, False
+
+    def put(self, key, version, markup):
+        with self._lock:
+            self._entries[key] = (version, markup)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+class ContentCache:
+    """رسائل المحتوى الجاهزة للإرسال مع حد أقصى لحجمها بالبايت"""
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._item_hits = {}
+        self._lock = threading.Lock()
+        # يرتفع مع كل حذف، فالقراءة التي بدأت قبل الحذف لا تُخزن نتيجتها
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content_id):
+        with self._lock:
+            entry = self._entries.get(content_id)
+            if entry:
+                self._entries.move_to_end(content_id)
+                self._item_hits[content_id] = self._item_hits.get(content_id, 0) + 1
+                self.hits += 1
+                return entry[0], True
+            self.misses += 1
+            return None, False
+
+    def put(self, content_id, payload, generation):
+        size = len(payload.text.encode('utf-8')) + len(payload.file_id or '')
+        with self._lock:
+            if generation != self.generation:
+                return
+            old = self._entries.pop(content_id, None)
+            if old:
+                self.size -= old[1]
+            self._entries[content_id] = (payload, size)
+            self.size += size
+            # الأقدم استخداماً يُحذف أولاً
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                evicted_id, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self._item_hits.pop(evicted_id, None)
+
+    def invalidate(self, content_id=None):
+        """حذف عنصر واحد، أو الجميع إذا لم يُحدد"""
+        with self._lock:
+            self.generation += 1
+            if content_id is None:
+                self._entries.clear()
+                self._item_hits.clear()
+                self.size = 0
+            else:
+                entry = self._entries.pop(content_id, None)
+                if entry:
+                    self.size -= entry[1]
+                self._item_hits.pop(content_id, None)
+
+    def hot(self, limit=5):
+        """أكثر العناصر المخزنة طلباً: (المعرف، العنوان، عدد الإصابات)"""
+        with self._lock:
+            items = [(content_id, entry[0].title, self._item_hits.get(content_id, 0))
+                     for content_id, entry in self._entries.items()]
+        return sorted(items, key=lambda item: -item[2])[:limit]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'bytes': self.size}
+
+class UserCache:
+    """صفوف المستخدمين الأخيرة بحد أقصى للعدد ومدة صلاحية"""
+    # رقم الجيل يمنع تخزين قراءة بدأت قبل آخر تعديل على المستخدمين
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1], True
+            self.misses += 1
+            return None, False
+
+    def put(self, user_id, user, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """حذف مستخدم واحد، أو الجميع إذا لم يُحدد"""
+        with self._lock:
+            self.generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+class LatencyHistogram:
+    """توزيع أزمنة التنفيذ على حدود ثابتة بالثواني كما في Prometheus"""
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.BUCKETS) and seconds > self.BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """تقدير تقريبي: حد الفئة التي يقع فيها الترتيب المطلوب"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.BUCKETS, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Metrics:
+    """مقاييس الأداء: توزيع الأزمنة والعدادات لكل (اسم، قيمة التصنيف)، ونسب إصابة الكاش"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.caches = {}
+
+    def observe(self, name, label, seconds):
+        with self._lock:
+            histogram = self.histograms.get((name, label))
+            if histogram is None:
+                histogram = self.histograms[(name, label)] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, label, amount=1):
+        with self._lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + amount
+
+    def summary(self, name):
+        """(التصنيف، العدد، المجموع، p50، p95) لكل توزيع باسم name، مرتبة من الأكثر وقتاً"""
+        with self._lock:
+            rows = [
+                (label, histogram.count, histogram.total, histogram.quantile(0.5), histogram.quantile(0.95))
+                for (histogram_name, label), histogram in self.histograms.items() if histogram_name == name
+            ]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def counter(self, name, label):
+        return self.counters.get((name, label), 0)
+
+    def register_cache(self, name, stats):
+        """stats دالة تعيد قاموساً فيه hits و misses و size"""
+        self.caches[name] = stats
+
+    def cache_stats(self):
+        return {name: stats() for name, stats in self.caches.items()}
+
+    def render(self):
+        """المقاييس بصيغة النص التي يقرأها Prometheus"""
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        declared = set()
+        for (name, label), histogram in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(LatencyHistogram.BUCKETS, histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{name="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{name="{label}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{name="{label}"}} {histogram.total:.6f}')
+            lines.append(f'{name}_count{{name="{label}"}} {histogram.count}')
+
+        for (name, label), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{{name="{label}"}} {value}')
+
+        lines.append('# TYPE bot_cache_requests_total counter')
+        lines.append('# TYPE bot_cache_size gauge')
+        for cache, stats in sorted(self.cache_stats().items()):
+            lines.append(f'bot_cache_requests_total{{cache="{cache}",result="hit"}} {stats["hits"]}')
+            lines.append(f'bot_cache_requests_total{{cache="{cache}",result="miss"}} {stats["misses"]}')
+            lines.append(f'bot_cache_size{{cache="{cache}"}} {stats["size"]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def timed_handler(handler):
+    """قياس زمن تنفيذ معالج التحديثات في bot_handler_seconds"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', handler.__name__)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', handler.__name__, time.perf_counter() - started)
+    return wrapper
+
+# مفتاح الجدول في النسخة الاحتياطية ← (اسم الجدول في قاعدة البيانات، المفتاح الأساسي)
+BACKUP_TABLES = [
+    ('users', 'users', 'user_id'),
+    ('categories', 'categories', 'id'),
+    ('content', 'content', 'id'),
+    ('settings', 'bot_settings', 'key'),
+    ('join_requests', 'join_requests', 'user_id'),
+]
+# last_active يتغير مع كل رسالة فلا يُسجل في سجل التغييرات
+TRACKED_USER_COLUMNS = [
+    'user_id', 'username', 'first_name', 'last_name', 'is_approved',
+    'is_admin', 'is_premium', 'joined_date', 'has_subscribed',
+]
+# الفهارس الثانوية (الاسم، الجدول، الأعمدة). رقم الإصدار جزء من اسم الفهرس، فعند تغيير
+# الأعمدة يُرفع INDEX_VERSION لتُبنى الفهارس الجديدة وتُحذف القديمة عند التشغيل التالي
+INDEX_VERSION = 1
+SCHEMA_INDEXES = [
+    ('content_category_date', 'content', 'category_id, created_date'),
+    ('content_date', 'content', 'created_date'),
+    ('users_approved_active', 'users', 'is_approved, last_active'),
+    ('backups_date', 'backups', 'backup_date'),
+    ('join_requests_date', 'join_requests', 'request_date, user_id'),
+]
+# الاستعلامات الأكثر تكراراً مع قيم تجريبية، وتُفحص خطة تنفيذها عند التشغيل
+HOT_QUERIES = [
+    ('content_by_category', 'SELECT * FROM content WHERE category_id = ? ORDER BY created_date DESC', (1,)),
+    ('content_page_category', '''
+        SELECT * FROM content WHERE category_id = ?
+        AND (created_date < ? OR (created_date = ? AND id < ?))
+        ORDER BY created_date DESC, id DESC LIMIT ?
+    ''', (1, '', '', 0, 10)),
+    ('content_page_all', '''
+        SELECT * FROM content WHERE (created_date < ? OR (created_date = ? AND id < ?))
+        ORDER BY created_date DESC, id DESC LIMIT ?
+    ''', ('', '', 0, 15)),
+    ('recent_content', '''
+        SELECT c.*, cat.name as category_name
+        FROM content c JOIN categories cat ON c.category_id = cat.id
+        ORDER BY c.created_date DESC LIMIT ?
+    ''', (7,)),
+    ('backup_history', 'SELECT * FROM backups ORDER BY backup_date DESC LIMIT 10', ()),
+    ('join_requests_page', 'SELECT * FROM join_requests ORDER BY request_date, user_id LIMIT ? OFFSET ?', (20, 0)),
+]
+
+# أنواع الصفوف التي تعيدها Database. تبقى tuple فتعمل الفهرسة بالموقع، لكن الوصول بالاسم
+# لا يتأثر بإضافة أعمدة لأن الاستعلامات تختار الأعمدة بأسمائها لا بـ SELECT *
+User = namedtuple('User', [
+    'user_id', 'username', 'first_name', 'last_name', 'is_approved',
+    'is_admin', 'is_premium', 'joined_date', 'last_active', 'has_subscribed',
+])
+Category = namedtuple('Category', ['id', 'name', 'created_date'])
+# category_name يُملأ فقط في الاستعلامات التي تضم جدول الأقسام
+Content = namedtuple('Content', [
+    'id', 'title', 'content', 'content_type', 'category_id', 'file_id', 'created_date', 'category_name',
+], defaults=[None])
+JoinRequest = namedtuple('JoinRequest', ['user_id', 'username', 'first_name', 'last_name', 'request_date'])
+Broadcast = namedtuple('Broadcast', ['id', 'text', 'admin_chat_id', 'status', 'created_date', 'finished_date', 'kind'])
+BackupRecord = namedtuple('BackupRecord', [
+    'id', 'backup_name', 'backup_date', 'file_size', 'description', 'kind', 'archive_id', 'parent_id', 'change_seq',
+])
+
+USER_COLUMNS = ', '.join(User._fields)
+CATEGORY_COLUMNS = ', '.join(Category._fields)
+CONTENT_COLUMNS = ', '.join(Content._fields[:-1])
+JOINED_CONTENT_COLUMNS = ', '.join(f'c.{field}' for field in Content._fields[:-1]) + ', cat.name'
+JOIN_REQUEST_COLUMNS = ', '.join(JoinRequest._fields)
+BROADCAST_COLUMNS = ', '.join(Broadcast._fields)
+BACKUP_COLUMNS = ', '.join(BackupRecord._fields)
+
+BACKUP_MANIFEST = 'backup_manifest.json'
+LEGACY_BACKUP_FILE = 'backup_data.json'
+
+# التشكيل والتطويل يُحذفان، وصور الألف والياء والتاء المربوطة توحد قبل الفهرسة والبحث
+ARABIC_DIACRITICS = re.compile(r'[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_FOLDING = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ة': 'ه'})
+# أداة التعريف وما يسبقها (وال، بال، فال، كال، لل) تُحذف إذا بقي بعدها حرفان على الأقل
+ARABIC_ARTICLE = re.compile(r'\b(?:[وبفك]?ال|لل)(?=\w{2})')
+
+def normalize_arabic(text):
+    if not text:
+        return ''
+    text = ARABIC_DIACRITICS.sub('', text).translate(ARABIC_FOLDING).lower()
+    return ARABIC_ARTICLE.sub('', text)
+
+def search_match_expression(text):
+    """تحويل نص المستخدم إلى تعبير MATCH: كل كلمة تُطابق كبادئة ويجب أن تظهر جميعها"""
+    words = re.findall(r'\w+', normalize_arabic(text))
+    return ' '.join(f'"{word}"*' for word in words)
+
+def search_snippet(body, text, size=10):
+    """مقتطف من النص الأصلي حول الكلمات المطابقة، مع تمييزها بـ «»"""
+    terms = re.findall(r'\w+', normalize_arabic(text))
+    tokens = (body or '').split()
+    matched = [
+        any(word.startswith(term) for word in re.findall(r'\w+', normalize_arabic(token)) for term in terms)
+        for token in tokens
+    ]
+    # النافذة التي تحوي أكبر عدد من الكلمات المطابقة، وتبدأ قبل أول تطابق بكلمتين إن أمكن
+    first = matched.index(True) if True in matched else 0
+    start = max(
+        range(max(len(tokens) - size, 0) + 1),
+        key=lambda i: (sum(matched[i:i + size]), -abs(i - (first - 2)))
+    )
+    words = [f"«{token}»" if hit else token for token, hit in zip(tokens[start:start + size], matched[start:start + size])]
+    prefix = '…' if start else ''
+    suffix = '…' if start + size < len(tokens) else ''
+    return prefix + ' '.join(words) + suffix
+
+def read_backup_archive(zip_file):
+    """قراءة النسخة الاحتياطية بالصيغة القديمة (JSON واحد) أو الجديدة (JSON Lines)"""
+    # الصفوف في الصيغة الجديدة تُقرأ سطراً بسطر دون تحميل الأرشيف كاملاً
+    names = zip_file.namelist()
+    if LEGACY_BACKUP_FILE in names or BACKUP_MANIFEST not in names:
+        backup_data = json.loads(zip_file.read(LEGACY_BACKUP_FILE).decode('utf-8'))
+        tables = (
+            (key, backup_data[key].get('columns', []), backup_data[key].get('data') or [], [])
+            for key, _, _ in BACKUP_TABLES if key in backup_data
+        )
+        return {'timestamp': backup_data.get('timestamp'), 'kind': 'full'}, tables
+
+    manifest = json.loads(zip_file.read(BACKUP_MANIFEST).decode('utf-8'))
+
+    def read_lines(name):
+        if name not in names:
+            return
+        with zip_file.open(name) as entry:
+            for line in io.TextIOWrapper(entry, encoding='utf-8'):
+                if line.strip():
+                    yield json.loads(line)
+
+    tables = (
+        (key, info['columns'], read_lines(f'{key}.jsonl'), read_lines(f'{key}.deleted.jsonl'))
+        for key, info in manifest['tables'].items()
+    )
+    return manifest, tables
+
+def write_jsonl(zip_file, name, rows):
+    count = 0
+    with zip_file.open(name, 'w') as entry:
+        for row in rows:
+            entry.write(json.dumps(row, ensure_ascii=False).encode('utf-8') + b'\n')
+            count += 1
+    return count
+
+def sqlite_pragmas():
+    """إعدادات الاتصال بـ SQLite، ويمكن تعديل كل منها من متغيرات البيئة"""
+    return [
+        # WAL يسمح للقراءة بالعمل أثناء الكتابة، و NORMAL آمن معه ولا يزامن القرص مع كل معاملة
+        ('journal_mode', os.getenv('DB_JOURNAL_MODE', 'WAL')),
+        ('synchronous', os.getenv('DB_SYNCHRONOUS', 'NORMAL')),
+        # القيمة السالبة بالكيلوبايت لكل اتصال
+        ('cache_size', int(os.getenv('DB_CACHE_SIZE', -16000))),
+        ('mmap_size', int(os.getenv('DB_MMAP_SIZE', 134217728))),
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', int(os.getenv('DB_BUSY_TIMEOUT', 5000))),
+    ]
+
+def apply_pragmas(conn, pragmas):
+    for name, value in pragmas:
+        result = conn.execute(f'PRAGMA {name} = {value}').fetchone()
+        if name == 'journal_mode' and result and result[0].upper() != str(value).upper():
+            logger.warning(f"⚠️ تعذر تفعيل journal_mode={value}، الوضع الحالي: {result[0]}")
+
+class Database:
+    def __init__(self, path=None):
+        self.path = path or os.getenv('DB_PATH', 'content_bot.db')
+        self._local = threading.local()
+        self._readers = []
+        self.pragmas = sqlite_pragmas()
+        self._conn = self.connect()
+        apply_pragmas(self._conn, self.pragmas)
+        self.activity = ActivityBuffer(
+            interval=int(os.getenv('ACTIVITY_FLUSH_INTERVAL', 30)),
+            max_pending=int(os.getenv('ACTIVITY_FLUSH_SIZE', 500))
+        )
+        self.views = ViewCounter(interval=int(os.getenv('ACTIVITY_FLUSH_INTERVAL', 30)))
+        self.statistics = TimedCache(ttl=int(os.getenv('STATS_CACHE_TTL', 60)))
+        self.payloads = ContentCache(max_bytes=int(os.getenv('CONTENT_CACHE_BYTES', 8 * 1024 * 1024)))
+        self.users = UserCache(
+            max_entries=int(os.getenv('USER_CACHE_SIZE', 10000)), ttl=int(os.getenv('USER_CACHE_TTL', 300))
+        )
+        self.settings = SettingsCache()
+        self.categories = CategoryIndex()
+        # يزداد مع كل تعديل على الأقسام أو المحتوى لإبطال اللوحات المحفوظة
+        self.catalog_version = 0
         self.create_tables()
+        self.check_query_plans()
         self.create_admin()
         self.create_default_settings()
+        self.reload_settings()
+        self.reload_categories()
+
+    @property
+    def conn(self):
+        # خيوط القراءة تستخدم اتصالها الخاص، وباقي العمليات تستخدم اتصال الكتابة الرئيسي
+        return getattr(self._local, 'conn', None) or self._conn
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        # تستخدمها مشغلات فهرس البحث، فيجب تسجيلها على كل اتصال
+        conn.create_function('normalize_ar', 1, normalize_arabic, deterministic=True)
+        return conn
+
+    def query(self, model, sql, params=()):
+        """تنفيذ استعلام تُعاد صفوفه من النوع model"""
+        cursor = self.conn.cursor()
+        cursor.row_factory = lambda _, row: model(*row)
+        return cursor.execute(sql, params)
+
+    def open_reader(self):
+        """فتح اتصال قراءة خاص بالخيط الحالي"""
+        conn = self.connect()
+        # وضع السجل خاص بملف قاعدة البيانات ويضبطه اتصال الكتابة وحده
+        apply_pragmas(conn, [pragma for pragma in self.pragmas if pragma[0] != 'journal_mode'])
+        self._readers.append(conn)
+        self._local.conn = conn
+
+    def close(self):
+        for conn in self._readers:
+            conn.close()
+        self._readers.clear()
+        self._conn.close()
 
     def create_tables(self):
+        self.migrate()
+        self.create_indexes()
+        self.conn.commit()
+
+    def migrate(self):
+        """تطبيق ترحيلات المخطط التي لم تُطبق بعد حسب PRAGMA user_version"""
+        # كل ترحيل يعمل في معاملة واحدة مع رفع رقم الإصدار
+        migrations = [
+            self._migration_base_tables,
+            self._migration_broadcasts,
+            self._migration_backup_chain,
+            self._migration_content_search,
+            self._migration_persistence,
+            self._migration_content_views,
+            self._migration_broadcast_kind,
+            self._migration_search_articles,
+        ]
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > len(migrations):
+            logger.warning(f"⚠️ إصدار قاعدة البيانات {version} أحدث من إصدار البوت {len(migrations)}")
+            return version
+
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            try:
+                self.conn.execute('BEGIN')
+                migration()
+                self.conn.execute(f'PRAGMA user_version = {number}')
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                logger.error(f"خطأ في ترحيل قاعدة البيانات إلى الإصدار {number}: {e}")
+                raise
+            logger.info(f"🧱 تم ترحيل قاعدة البيانات إلى الإصدار {number}")
+        return len(migrations)
+
+    def _migration_base_tables(self):
         # جدول المستخدمين
         self.conn.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -80,7 +753,7 @@ class Database:
                 value TEXT
             )
         ''')
-        
+
         # جدول النسخ الاحتياطية
         self.conn.execute('''
             CREATE TABLE IF NOT EXISTS backups (
@@ -91,7 +764,167 @@ class Database:
                 description TEXT
             )
         ''')
-        self.conn.commit()
+
+    def _migration_broadcasts(self):
+        # جدول البث الجماعي وحالة كل مستلم لاستئناف البث بعد إعادة التشغيل
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT,
+                admin_chat_id INTEGER,
+                status TEXT DEFAULT 'running',
+                created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_date TIMESTAMP
+            )
+        ''')
+
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                broadcast_id INTEGER,
+                user_id INTEGER,
+                status TEXT DEFAULT 'pending',
+                PRIMARY KEY (broadcast_id, user_id)
+            )
+        ''')
+
+    def _migration_backup_chain(self):
+        # بيانات سلسلة النسخ التفاضلية: كل نسخة تشير إلى النسخة التي بُنيت عليها
+        self._add_column_if_missing('backups', 'kind', "TEXT DEFAULT 'full'")
+        self._add_column_if_missing('backups', 'archive_id', 'TEXT')
+        self._add_column_if_missing('backups', 'parent_id', 'TEXT')
+        self._add_column_if_missing('backups', 'change_seq', 'INTEGER')
+
+        # سجل التغييرات الذي تُبنى منه النسخ التفاضلية، ويُملأ بواسطة المشغلات
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS change_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT,
+                row_key,
+                changed_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        for _, table, key_column in BACKUP_TABLES:
+            tracked = f" OF {', '.join(TRACKED_USER_COLUMNS)}" if table == 'users' else ''
+            self.conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_log_insert AFTER INSERT ON {table}
+                BEGIN
+                    INSERT INTO change_log (table_name, row_key) VALUES ('{table}', NEW.{key_column});
+                END
+            ''')
+            self.conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_log_update AFTER UPDATE{tracked} ON {table}
+                BEGIN
+                    INSERT INTO change_log (table_name, row_key) VALUES ('{table}', NEW.{key_column});
+                    INSERT INTO change_log (table_name, row_key)
+                    SELECT '{table}', OLD.{key_column} WHERE OLD.{key_column} IS NOT NEW.{key_column};
+                END
+            ''')
+            self.conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_log_delete AFTER DELETE ON {table}
+                BEGIN
+                    INSERT INTO change_log (table_name, row_key) VALUES ('{table}', OLD.{key_column});
+                END
+            ''')
+
+    def _migration_content_search(self):
+        # فهرس البحث النصي: rowid هو معرف المحتوى، والنص يُخزن بعد التوحيد
+        self.conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS content_search USING fts5(title, body, tokenize = 'unicode61')
+        ''')
+        self.conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS content_search_insert AFTER INSERT ON content
+            BEGIN
+                INSERT INTO content_search (rowid, title, body)
+                VALUES (NEW.id, normalize_ar(NEW.title), normalize_ar(NEW.content));
+            END
+        ''')
+        self.conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS content_search_update AFTER UPDATE OF id, title, content ON content
+            BEGIN
+                DELETE FROM content_search WHERE rowid = OLD.id;
+                INSERT INTO content_search (rowid, title, body)
+                VALUES (NEW.id, normalize_ar(NEW.title), normalize_ar(NEW.content));
+            END
+        ''')
+        self.conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS content_search_delete AFTER DELETE ON content
+            BEGIN
+                DELETE FROM content_search WHERE rowid = OLD.id;
+            END
+        ''')
+        self.rebuild_content_search()
+
+    def _migration_persistence(self):
+        # user_data و chat_data الخاصة بـ PTB بصيغة JSON، ولا تدخل في النسخ الاحتياطية
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS persistence (
+                kind TEXT,
+                key INTEGER,
+                data TEXT,
+                updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (kind, key)
+            )
+        ''')
+
+    def _migration_content_views(self):
+        # جدول منفصل حتى لا يمر كل تحديث للعداد بمشغلات سجل التغييرات وفهرس البحث
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS content_views (
+                content_id INTEGER PRIMARY KEY,
+                views INTEGER DEFAULT 0
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS content_views_delete AFTER DELETE ON content
+            BEGIN
+                DELETE FROM content_views WHERE content_id = OLD.id;
+            END
+        ''')
+
+    def _migration_broadcast_kind(self):
+        # محرك البث يرسل أيضاً إشعارات الموافقة والرفض الجماعية
+        self._add_column_if_missing('broadcasts', 'kind', "TEXT DEFAULT 'broadcast'")
+
+    def _migration_search_articles(self):
+        # normalize_arabic أصبحت تحذف أداة التعريف، فيُعاد فهرسة المحتوى الموجود
+        self.rebuild_content_search()
+
+    def rebuild_content_search(self):
+        self.conn.execute('DELETE FROM content_search')
+        self.conn.execute('''
+            INSERT INTO content_search (rowid, title, body)
+            SELECT id, normalize_ar(title), normalize_ar(content) FROM content
+        ''')
+
+    def create_indexes(self):
+        wanted = set()
+        for name, table, columns in SCHEMA_INDEXES:
+            index_name = f'idx_{name}_v{INDEX_VERSION}'
+            wanted.add(index_name)
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})')
+
+        # حذف فهارس الإصدارات السابقة
+        cursor = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx!_%' ESCAPE '!'")
+        for (index_name,) in cursor.fetchall():
+            if index_name not in wanted:
+                self.conn.execute(f'DROP INDEX IF EXISTS "{index_name}"')
+                logger.info(f"🗑️ حذف فهرس قديم: {index_name}")
+
+    def check_query_plans(self):
+        """فحص خطط الاستعلامات المتكررة وإعادة ما تراجع منها إلى مسح كامل أو ترتيب مؤقت"""
+        regressions = []
+        for name, query, params in HOT_QUERIES:
+            for row in self.conn.execute(f'EXPLAIN QUERY PLAN {query}', params):
+                detail = row[3]
+                if (detail.startswith('SCAN ') and ' USING ' not in detail) or 'TEMP B-TREE' in detail:
+                    regressions.append((name, detail))
+                    logger.warning(f"⚠️ الاستعلام {name} لا يستخدم فهرساً: {detail}")
+        return regressions
+
+    def _add_column_if_missing(self, table, column, definition):
+        columns = {info[1] for info in self.conn.execute(f'PRAGMA table_info({table})')}
+        if column not in columns:
+            self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
 
     def create_admin(self):
         admin_id = int(os.getenv('ADMIN_ID', 123456789))
@@ -120,14 +953,26 @@ class Database:
             self.conn.execute('INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)', (key, value))
         self.conn.commit()
 
+    def reload_settings(self):
+        cursor = self.conn.execute('SELECT key, value FROM bot_settings')
+        self.settings.load(cursor.fetchall())
+
     def get_setting(self, key):
+        value, hit = self.settings.get(key)
+        if hit:
+            return value
+        return self.load_setting(key)
+
+    def load_setting(self, key):
         cursor = self.conn.execute('SELECT value FROM bot_settings WHERE key = ?', (key,))
         result = cursor.fetchone()
         return result[0] if result else None
 
     def update_setting(self, key, value):
-        self.conn.execute('UPDATE bot_settings SET value = ? WHERE key = ?', (value, key))
+        cursor = self.conn.execute('UPDATE bot_settings SET value = ? WHERE key = ?', (value, key))
         self.conn.commit()
+        if cursor.rowcount:
+            self.settings.set(key, value)
 
     def get_all_settings(self):
         cursor = self.conn.execute('SELECT * FROM bot_settings')
@@ -139,70 +984,279 @@ class Database:
             VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
         ''', (user_id, username, first_name, last_name, is_approved, is_admin))
         self.conn.commit()
+        self.users.invalidate(user_id)
+
+    def register_user(self, user_id, username, first_name, last_name):
+        """تسجيل مستخدم جديد وتطبيق سياسة القبول في معاملة واحدة"""
+        # المستخدم الموجود لا تُسحب موافقته
+        approve = self.get_setting('auto_approve') == '1' or self.get_setting('approval_required') != '1'
+        try:
+            user = self.query(User, f'''
+                INSERT INTO users (user_id, username, first_name, last_name, is_approved, last_active)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    is_approved = MAX(is_approved, excluded.is_approved),
+                    last_active = excluded.last_active
+                RETURNING {USER_COLUMNS}
+            ''', (user_id, username, first_name, last_name, int(approve))).fetchone()
+            if user.is_approved:
+                self.conn.execute('DELETE FROM join_requests WHERE user_id = ?', (user_id,))
+            else:
+                self.conn.execute('''
+                    INSERT OR REPLACE INTO join_requests (user_id, username, first_name, last_name)
+                    VALUES (?, ?, ?, ?)
+                ''', (user_id, username, first_name, last_name))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        # الصف المعاد هو الحالة بعد الكتابة، فيُخزن مباشرة للرسالة التالية
+        self.users.invalidate(user_id)
+        self.users.put(user_id, user, self.users.generation)
+        return user
 
     def update_user_activity(self, user_id):
-        self.conn.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
-        self.conn.commit()
+        # يُسجل في الذاكرة فقط، والكتابة الفعلية تتم في flush_activity
+        self.activity.touch(user_id)
+
+    def flush_activity(self):
+        pending = self.activity.drain()
+        if not pending:
+            return 0
+        try:
+            self.conn.executemany(
+                'UPDATE users SET last_active = ? WHERE user_id = ?',
+                [(stamp, user_id) for user_id, stamp in pending.items()]
+            )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            self.activity.done(failed=True)
+            raise
+        self.activity.done()
+        return len(pending)
+
+    def record_content_view(self, content_id):
+        self.views.add(content_id)
+
+    def flush_content_views(self):
+        pending = self.views.drain()
+        if not pending:
+            return 0
+        try:
+            self.conn.executemany('''
+                INSERT INTO content_views (content_id, views) VALUES (?, ?)
+                ON CONFLICT (content_id) DO UPDATE SET views = views + excluded.views
+            ''', list(pending.items()))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            self.views.restore(pending)
+            raise
+        return len(pending)
+
+    def get_statistics(self, days=30):
+        """كل أرقام شاشة الإحصائيات في استدعاء واحد"""
+        # النشاط الذي لم يُكتب بعد يُضاف إلى أعداد النشطين
+        now = datetime.utcnow()
+        active_cutoff = (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        day_cutoff = (now - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+        today = now.strftime('%Y-%m-%d 00:00:00')
+        week_cutoff = (now - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
+
+        users = self.conn.execute('''
+            SELECT
+                COUNT(*),
+                COUNT(CASE WHEN last_active > ? THEN 1 END),
+                COUNT(CASE WHEN last_active > ? THEN 1 END),
+                COUNT(CASE WHEN joined_date >= ? THEN 1 END),
+                COUNT(CASE WHEN joined_date >= ? THEN 1 END),
+                COUNT(CASE WHEN has_subscribed = 1 THEN 1 END)
+            FROM users WHERE is_approved = 1
+        ''', (active_cutoff, day_cutoff, today, week_cutoff)).fetchone()
+        total_users, active_users, daily_active, new_today, new_week, subscribed = users
+
+        pending = self.activity.snapshot()
+        if pending:
+            stale = self._users_last_active(pending)
+            for user_id, stamp in pending.items():
+                last_active = stale.get(user_id)
+                if last_active is None:
+                    continue
+                if stamp > active_cutoff >= last_active:
+                    active_users += 1
+                if stamp > day_cutoff >= last_active:
+                    daily_active += 1
+
+        per_category = dict(self.conn.execute('SELECT category_id, COUNT(*) FROM content GROUP BY category_id'))
+        total_views = self.conn.execute('SELECT COALESCE(SUM(views), 0) FROM content_views').fetchone()[0]
+        top_content = self.conn.execute('''
+            SELECT c.title, v.views FROM content_views v JOIN content c ON c.id = v.content_id
+            ORDER BY v.views DESC LIMIT 5
+        ''').fetchall()
+        categories = self.categories.all()
+        return {
+            'total_users': total_users,
+            'active_users': active_users,
+            'daily_active': daily_active,
+            'new_today': new_today,
+            'new_week': new_week,
+            'subscribed': subscribed,
+            'pending_requests': self.conn.execute('SELECT COUNT(*) FROM join_requests').fetchone()[0],
+            'total_content': sum(per_category.values()),
+            'total_categories': len(categories),
+            'per_category': [(category.name, per_category.get(category.id, 0)) for category in categories],
+            'total_views': total_views,
+            'top_content': top_content,
+        }
+
+    def _users_last_active(self, user_ids):
+        """آخر نشاط مكتوب للمستخدمين المقبولين من القائمة"""
+        user_ids = list(user_ids)
+        result = {}
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            placeholders = ', '.join(['?'] * len(chunk))
+            cursor = self.conn.execute(
+                f'SELECT user_id, last_active FROM users WHERE is_approved = 1 AND user_id IN ({placeholders})', chunk
+            )
+            result.update(cursor.fetchall())
+        return result
 
     def get_user(self, user_id):
-        cursor = self.conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        cursor = self.query(User, f'SELECT {USER_COLUMNS} FROM users WHERE user_id = ?', (user_id,))
         return cursor.fetchone()
 
     def approve_user(self, user_id):
         self.conn.execute('UPDATE users SET is_approved = 1 WHERE user_id = ?', (user_id,))
         self.conn.execute('DELETE FROM join_requests WHERE user_id = ?', (user_id,))
         self.conn.commit()
+        self.users.invalidate(user_id)
 
     def reject_user(self, user_id):
         self.conn.execute('DELETE FROM join_requests WHERE user_id = ?', (user_id,))
         self.conn.commit()
 
     def get_all_users(self):
-        cursor = self.conn.execute('SELECT * FROM users WHERE is_approved = 1')
-        return cursor.fetchall()
-
-    def get_active_users(self, days=30):
-        cutoff_date = datetime.now() - timedelta(days=days)
-        cursor = self.conn.execute('''
-            SELECT * FROM users 
-            WHERE is_approved = 1 AND last_active > ?
-        ''', (cutoff_date,))
+        cursor = self.query(User, f'SELECT {USER_COLUMNS} FROM users WHERE is_approved = 1')
         return cursor.fetchall()
 
     def get_pending_requests(self):
-        cursor = self.conn.execute('SELECT * FROM join_requests')
+        cursor = self.query(JoinRequest, f'SELECT {JOIN_REQUEST_COLUMNS} FROM join_requests')
         return cursor.fetchall()
 
+    def get_request_page(self, offset=0, limit=20):
+        cursor = self.query(
+            JoinRequest, f'SELECT {JOIN_REQUEST_COLUMNS} FROM join_requests ORDER BY request_date, user_id LIMIT ? OFFSET ?',
+            (limit, offset)
+        )
+        total = self.conn.execute('SELECT COUNT(*) FROM join_requests').fetchone()[0]
+        return cursor.fetchall(), total
+
+    @staticmethod
+    def _request_filter(user_ids=None, older_than_days=None):
+        """شرط WHERE لاختيار طلبات الانضمام: قائمة محددة، أو الأقدم من عدد أيام، أو الكل"""
+        if user_ids is not None:
+            return f"user_id IN ({', '.join(['?'] * len(user_ids))})", list(user_ids)
+        if older_than_days is not None:
+            cutoff = (datetime.utcnow() - timedelta(days=older_than_days)).strftime('%Y-%m-%d %H:%M:%S')
+            return 'request_date <= ?', [cutoff]
+        return '1 = 1', []
+
+    def count_requests(self, user_ids=None, older_than_days=None):
+        where, params = self._request_filter(user_ids, older_than_days)
+        return self.conn.execute(f'SELECT COUNT(*) FROM join_requests WHERE {where}', params).fetchone()[0]
+
+    def moderate_requests(self, approve, notification, admin_chat_id, user_ids=None, older_than_days=None):
+        """قبول أو رفض مجموعة طلبات في معاملة واحدة، وتعيد (رقم البث، العدد)"""
+        where, params = self._request_filter(user_ids, older_than_days)
+        try:
+            cursor = self.conn.execute(
+                'INSERT INTO broadcasts (text, admin_chat_id, kind) VALUES (?, ?, ?)',
+                (notification, admin_chat_id, 'approval' if approve else 'rejection')
+            )
+            broadcast_id = cursor.lastrowid
+            self.conn.execute(f'''
+                INSERT INTO broadcast_recipients (broadcast_id, user_id)
+                SELECT ?, user_id FROM join_requests WHERE {where}
+            ''', [broadcast_id] + params)
+            if approve:
+                self.conn.execute(f'''
+                    UPDATE users SET is_approved = 1
+                    WHERE user_id IN (SELECT user_id FROM join_requests WHERE {where})
+                ''', params)
+            count = self.conn.execute(f'DELETE FROM join_requests WHERE {where}', params).rowcount
+            if not count:
+                self.conn.rollback()
+                return None, 0
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        if approve:
+            self.users.invalidate()
+        return broadcast_id, count
+
     def delete_user(self, user_id):
         self.conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
         self.conn.commit()
+        self.users.invalidate(user_id)
 
     def mark_user_subscribed(self, user_id):
         self.conn.execute('UPDATE users SET has_subscribed = 1 WHERE user_id = ?', (user_id,))
         self.conn.commit()
+        self.users.invalidate(user_id)
+
+    def mark_users_unsubscribed(self, user_ids):
+        self.conn.executemany('UPDATE users SET has_subscribed = 0 WHERE user_id = ?', [(user_id,) for user_id in user_ids])
+        self.conn.commit()
+        for user_id in user_ids:
+            self.users.invalidate(user_id)
+
+    def get_subscribed_user_ids(self, after_user_id=0, limit=200):
+        cursor = self.conn.execute('''
+            SELECT user_id FROM users
+            WHERE has_subscribed = 1 AND is_admin = 0 AND user_id > ?
+            ORDER BY user_id LIMIT ?
+        ''', (after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+    def reload_categories(self):
+        cursor = self.query(Category, f'SELECT {CATEGORY_COLUMNS} FROM categories ORDER BY name')
+        self.categories.load(cursor.fetchall())
+        self.catalog_version += 1
 
     def add_category(self, name):
         self.conn.execute('INSERT OR IGNORE INTO categories (name) VALUES (?)', (name,))
         self.conn.commit()
-        return self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        category_id = self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        self.reload_categories()
+        return category_id
 
     def get_categories(self):
-        cursor = self.conn.execute('SELECT * FROM categories ORDER BY name')
-        return cursor.fetchall()
+        return self.categories.all()
+
+    def get_category_id_by_name(self, name):
+        return self.categories.id_for(name)
 
     def update_category(self, category_id, name):
         self.conn.execute('UPDATE categories SET name = ? WHERE id = ?', (name, category_id))
         self.conn.commit()
+        self.reload_categories()
 
     def delete_category(self, category_id):
-        cursor = self.conn.execute('SELECT * FROM categories WHERE id = ?', (category_id,))
-        category = cursor.fetchone()
+        category = self.categories.get(category_id)
         if not category:
             return False
         
         self.conn.execute('DELETE FROM categories WHERE id = ?', (category_id,))
         self.conn.execute('DELETE FROM content WHERE category_id = ?', (category_id,))
         self.conn.commit()
+        self.reload_categories()
+        self.payloads.invalidate()
         return True
 
     def add_content(self, title, content, content_type, category_id, file_id=None):
@@ -211,23 +1265,58 @@ class Database:
             VALUES (?, ?, ?, ?, ?)
         ''', (title, content, content_type, category_id, file_id))
         self.conn.commit()
+        self.catalog_version += 1
         return self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
 
     def get_content_by_category(self, category_id):
-        cursor = self.conn.execute('SELECT * FROM content WHERE category_id = ? ORDER BY created_date DESC', (category_id,))
+        cursor = self.query(
+            Content, f'SELECT {CONTENT_COLUMNS} FROM content WHERE category_id = ? ORDER BY created_date DESC', (category_id,)
+        )
         return cursor.fetchall()
 
+    def get_content_page(self, category_id=None, cursor=None, direction='next', limit=10):
+        """صفحة من المحتوى من الأحدث بمؤشر (created_date, id)، وتعيد (الصفوف، سابقة، تالية)"""
+        conditions = []
+        params = []
+        if category_id is not None:
+            conditions.append('category_id = ?')
+            params.append(category_id)
+
+        if cursor and direction == 'prev':
+            conditions.append('(created_date > ? OR (created_date = ? AND id > ?))')
+            order = 'created_date ASC, id ASC'
+        else:
+            if cursor:
+                conditions.append('(created_date < ? OR (created_date = ? AND id < ?))')
+            order = 'created_date DESC, id DESC'
+        if cursor:
+            created_date, content_id = cursor
+            params.extend([created_date, created_date, content_id])
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        cursor_obj = self.query(
+            Content, f'SELECT {CONTENT_COLUMNS} FROM content {where} ORDER BY {order} LIMIT ?', (*params, limit + 1)
+        )
+        rows = cursor_obj.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        if cursor and direction == 'prev':
+            rows.reverse()
+            return rows, has_more, True
+        return rows, bool(cursor), has_more
+
     def get_all_content(self):
-        cursor = self.conn.execute('''
-            SELECT c.*, cat.name as category_name 
+        cursor = self.query(Content, f'''
+            SELECT {JOINED_CONTENT_COLUMNS}
             FROM content c JOIN categories cat ON c.category_id = cat.id 
             ORDER BY c.created_date DESC
         ''')
         return cursor.fetchall()
 
     def get_recent_content(self, limit=7):
-        cursor = self.conn.execute('''
-            SELECT c.*, cat.name as category_name 
+        cursor = self.query(Content, f'''
+            SELECT {JOINED_CONTENT_COLUMNS}
             FROM content c JOIN categories cat ON c.category_id = cat.id 
             ORDER BY c.created_date DESC 
             LIMIT ?
@@ -235,133 +1324,553 @@ class Database:
         return cursor.fetchall()
 
     def delete_content(self, content_id):
-        cursor = self.conn.execute('SELECT * FROM content WHERE id = ?', (content_id,))
+        cursor = self.conn.execute('SELECT 1 FROM content WHERE id = ?', (content_id,))
         content = cursor.fetchone()
         if not content:
             return False
         
         self.conn.execute('DELETE FROM content WHERE id = ?', (content_id,))
         self.conn.commit()
+        self.catalog_version += 1
+        self.payloads.invalidate(content_id)
         return True
 
     def get_content(self, content_id):
-        cursor = self.conn.execute('SELECT * FROM content WHERE id = ?', (content_id,))
+        cursor = self.query(Content, f'SELECT {CONTENT_COLUMNS} FROM content WHERE id = ?', (content_id,))
         return cursor.fetchone()
 
     def get_category_by_id(self, category_id):
-        cursor = self.conn.execute('SELECT * FROM categories WHERE id = ?', (category_id,))
-        return cursor.fetchone()
+        return self.categories.get(category_id)
 
-    def search_content_by_title(self, title):
-        cursor = self.conn.execute('SELECT * FROM content WHERE title LIKE ?', (f'%{title}%',))
-        return cursor.fetchall()
+    def search_content(self, text, offset=0, limit=10):
+        """البحث مرتباً بـ bm25 مع وزن أكبر للعنوان، ويعيد (الصفوف، هل توجد صفحة تالية)"""
+        expression = search_match_expression(text)
+        if not expression:
+            return [], False
+        cursor = self.conn.execute('''
+            SELECT c.id, c.title, c.content
+            FROM content_search JOIN content c ON c.id = content_search.rowid
+            WHERE content_search MATCH ?
+            ORDER BY bm25(content_search, 5.0, 1.0)
+            LIMIT ? OFFSET ?
+        ''', (expression, limit + 1, offset))
+        rows = cursor.fetchall()
+        # جدول البحث يحفظ النص الموحد فقط، فالمقتطف يُبنى من النص الأصلي
+        results = [(content_id, title, search_snippet(body, text)) for content_id, title, body in rows[:limit]]
+        return results, len(rows) > limit
+
+    def current_change_seq(self):
+        cursor = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+        result = cursor.fetchone()
+        return result[0] if result else 0
 
-    def create_backup(self):
-        backup_data = {
+    def get_backup_base(self):
+        """آخر نسخة معروفة الهوية، وتُبنى عليها النسخة التفاضلية التالية"""
+        cursor = self.conn.execute('SELECT archive_id, change_seq FROM backups ORDER BY id DESC LIMIT 1')
+        result = cursor.fetchone()
+        return result if result and result[0] else None
+
+    def _rows_by_keys(self, table, key_column, keys, found):
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ', '.join(['?'] * len(chunk))
+            cursor = self.conn.execute(f'SELECT * FROM {table} WHERE {key_column} IN ({placeholders})', chunk)
+            key_index = [description[0] for description in cursor.description].index(key_column)
+            for row in cursor:
+                found.add(row[key_index])
+                yield row
+
+    def create_backup(self, fileobj, incremental=False):
+        """كتابة النسخة الاحتياطية مباشرة في ملف zip جدولاً بجدول"""
+        # كل جدول بصيغة JSON Lines، والنسخة التفاضلية تحتوي ما تغير منذ آخر نسخة والمحذوف
+        manifest = {
             'timestamp': datetime.now().isoformat(),
-            'version': '2.0',
-            'users': self.get_all_users_data(),
-            'categories': self.get_all_categories_data(),
-            'content': self.get_all_content_data(),
-            'settings': self.get_all_settings_data(),
-            'join_requests': self.get_all_join_requests_data()
+            'version': '3.1',
+            'kind': 'full',
+            'archive_id': uuid.uuid4().hex,
+            'parent_id': None,
+            'tables': {},
         }
-        return backup_data
-
-    def get_all_users_data(self):
-        cursor = self.conn.execute('SELECT * FROM users')
-        columns = [description[0] for description in cursor.description]
-        users = cursor.fetchall()
-        return {'columns': columns, 'data': users}
-
-    def get_all_categories_data(self):
-        cursor = self.conn.execute('SELECT * FROM categories')
-        columns = [description[0] for description in cursor.description]
-        categories = cursor.fetchall()
-        return {'columns': columns, 'data': categories}
-
-    def get_all_content_data(self):
-        cursor = self.conn.execute('SELECT * FROM content')
-        columns = [description[0] for description in cursor.description]
-        content = cursor.fetchall()
-        return {'columns': columns, 'data': content}
-
-    def get_all_settings_data(self):
-        cursor = self.conn.execute('SELECT * FROM bot_settings')
-        columns = [description[0] for description in cursor.description]
-        settings = cursor.fetchall()
-        return {'columns': columns, 'data': settings}
+        # قراءة كل الجداول من لقطة واحدة متسقة
+        self.conn.execute('BEGIN')
+        try:
+            change_seq = self.current_change_seq()
+            base = self.get_backup_base() if incremental else None
+            if base:
+                manifest['kind'] = 'delta'
+                manifest['parent_id'] = base[0]
+            manifest['change_seq'] = change_seq
+
+            with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                for key, table, key_column in BACKUP_TABLES:
+                    columns = [info[1] for info in self.conn.execute(f'PRAGMA table_info({table})')]
+                    deleted = []
+                    if base:
+                        cursor = self.conn.execute('''
+                            SELECT DISTINCT row_key FROM change_log
+                            WHERE table_name = ? AND id > ? AND id <= ?
+                        ''', (table, base[1] or 0, change_seq))
+                        keys = [row[0] for row in cursor.fetchall()]
+                        found = set()
+                        rows = self._rows_by_keys(table, key_column, keys, found)
+                        count = write_jsonl(zip_file, f'{key}.jsonl', rows)
+                        deleted = [row_key for row_key in keys if row_key not in found]
+                        if deleted:
+                            write_jsonl(zip_file, f'{key}.deleted.jsonl', deleted)
+                    else:
+                        count = write_jsonl(zip_file, f'{key}.jsonl', self.conn.execute(f'SELECT * FROM {table}'))
+                    manifest['tables'][key] = {'columns': columns, 'rows': count, 'deleted': len(deleted)}
+                zip_file.writestr(BACKUP_MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=2))
+        finally:
+            self.conn.execute('COMMIT')
+        return manifest
+
+    def _insert_statement(self, table, columns, verb='INSERT'):
+        live_columns = {info[1] for info in self.conn.execute(f'PRAGMA table_info({table})')}
+        unknown = [column for column in columns if column not in live_columns]
+        if unknown or len(set(columns)) != len(columns):
+            raise ValueError(f"أعمدة غير صالحة في جدول {table}: {', '.join(map(str, unknown or columns))}")
+
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        placeholders = ', '.join(['?'] * len(columns))
+        return f'{verb} INTO {table} ({column_list}) VALUES ({placeholders})'
+
+    def _executemany_chunked(self, statement, rows):
+        count = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, 1000))
+            if not chunk:
+                return count
+            self.conn.executemany(statement, chunk)
+            count += len(chunk)
+
+    def _replace_tables(self, tables):
+        """استبدال بيانات الجداول بمحتوى نسخة كاملة داخل معاملة المستدعي"""
+        # الفهارس والمشغلات تُحذف قبل الإدراج وتُعاد بعده
+        table_names = {key: table for key, table, _ in BACKUP_TABLES}
+        counts = {}
+
+        for table in table_names.values():
+            self.conn.execute(f'DELETE FROM {table}')
+
+        # تأجيل بناء الفهارس والمشغلات حتى انتهاء الإدراج
+        deferred = self.conn.execute(f'''
+            SELECT type, name, sql FROM sqlite_master
+            WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+            AND tbl_name IN ({', '.join(['?'] * len(table_names))})
+        ''', list(table_names.values())).fetchall()
+        for object_type, name, _ in deferred:
+            self.conn.execute(f'DROP {object_type.upper()} "{name}"')
+
+        for key, columns, rows, _ in tables:
+            table = table_names.get(key)
+            if not table:
+                continue
+            counts[key] = self._executemany_chunked(self._insert_statement(table, columns), rows)
+
+        for _, _, sql in deferred:
+            self.conn.execute(sql)
+        # مشغلات فهرس البحث وحذف المشاهدات كانت معطلة أثناء الإدراج
+        self.rebuild_content_search()
+        self.conn.execute('DELETE FROM content_views WHERE content_id NOT IN (SELECT id FROM content)')
+        return counts
+
+    def _apply_delta(self, tables):
+        table_names = {key: (table, key_column) for key, table, key_column in BACKUP_TABLES}
+        counts = {'deleted': 0}
+        for key, columns, rows, deleted in tables:
+            if key not in table_names:
+                continue
+            table, key_column = table_names[key]
+            statement = self._insert_statement(table, columns, 'INSERT OR REPLACE')
+            counts[key] = self._executemany_chunked(statement, rows)
+            counts['deleted'] += self._executemany_chunked(
+                f'DELETE FROM {table} WHERE {key_column} = ?', ((row_key,) for row_key in deleted)
+            )
+        return counts
 
-    def get_all_join_requests_data(self):
-        cursor = self.conn.execute('SELECT * FROM join_requests')
-        columns = [description[0] for description in cursor.description]
-        requests = cursor.fetchall()
-        return {'columns': columns, 'data': requests}
+    def restore_backup_archive(self, path, backup_name=None, file_size=0):
+        """استعادة نسخة كاملة أو تطبيق نسخة تفاضلية من ملف zip"""
+        # التفاضلية لا تُطبق إلا فوق النسخة التي بُنيت عليها
+        with zipfile.ZipFile(path, 'r') as zip_file:
+            manifest, tables = read_backup_archive(zip_file)
+            try:
+                self.conn.execute('BEGIN TRANSACTION')
+                if manifest.get('kind') == 'delta':
+                    base = self.get_backup_base()
+                    if not base or base[0] != manifest.get('parent_id'):
+                        raise ValueError("يجب استعادة النسخة السابقة في السلسلة أولاً قبل هذه النسخة التفاضلية")
+                    counts = self._apply_delta(tables)
+                else:
+                    counts = self._replace_tables(tables)
+                # التغييرات الناتجة عن الاستعادة نفسها لا تدخل في النسخة التفاضلية التالية
+                self._insert_backup_record(
+                    backup_name, file_size, "استعادة نسخة احتياطية", manifest, self.current_change_seq()
+                )
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                logger.error(f"خطأ في استعادة النسخة الاحتياطية: {e}")
+                raise
+
+        self.reload_settings()
+        self.reload_categories()
+        self.users.invalidate()
+        self.payloads.invalidate()
+        return manifest, counts
+
+    def load_persistent_data(self, kind):
+        cursor = self.conn.execute('SELECT key, data FROM persistence WHERE kind = ?', (kind,))
+        return {key: json.loads(data) for key, data in cursor.fetchall()}
+
+    def save_persistent_data(self, rows):
+        """rows: (النوع، المفتاح، البيانات بصيغة JSON)، والبيانات None تعني حذف الصف"""
+        self.conn.executemany('''
+            INSERT OR REPLACE INTO persistence (kind, key, data, updated_date)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ''', [row for row in rows if row[2] is not None])
+        self.conn.executemany(
+            'DELETE FROM persistence WHERE kind = ? AND key = ?',
+            [(kind, key) for kind, key, data in rows if data is None]
+        )
+        self.conn.commit()
 
-    def restore_backup(self, backup_data):
-        try:
-            self.conn.execute('BEGIN TRANSACTION')
-            
-            self.conn.execute('DELETE FROM users')
-            self.conn.execute('DELETE FROM categories')
-            self.conn.execute('DELETE FROM content')
-            self.conn.execute('DELETE FROM bot_settings')
-            self.conn.execute('DELETE FROM join_requests')
-            
-            users_data = backup_data.get('users', {})
-            if users_data.get('data'):
-                columns = users_data['columns']
-                placeholders = ', '.join(['?'] * len(columns))
-                for row in users_data['data']:
-                    self.conn.execute(f'INSERT INTO users ({", ".join(columns)}) VALUES ({placeholders})', row)
-            
-            categories_data = backup_data.get('categories', {})
-            if categories_data.get('data'):
-                columns = categories_data['columns']
-                placeholders = ', '.join(['?'] * len(columns))
-                for row in categories_data['data']:
-                    self.conn.execute(f'INSERT INTO categories ({", ".join(columns)}) VALUES ({placeholders})', row)
-            
-            content_data = backup_data.get('content', {})
-            if content_data.get('data'):
-                columns = content_data['columns']
-                placeholders = ', '.join(['?'] * len(columns))
-                for row in content_data['data']:
-                    self.conn.execute(f'INSERT INTO content ({", ".join(columns)}) VALUES ({placeholders})', row)
-            
-            settings_data = backup_data.get('settings', {})
-            if settings_data.get('data'):
-                columns = settings_data['columns']
-                placeholders = ', '.join(['?'] * len(columns))
-                for row in settings_data['data']:
-                    self.conn.execute(f'INSERT INTO bot_settings ({", ".join(columns)}) VALUES ({placeholders})', row)
-            
-            requests_data = backup_data.get('join_requests', {})
-            if requests_data.get('data'):
-                columns = requests_data['columns']
-                placeholders = ', '.join(['?'] * len(columns))
-                for row in requests_data['data']:
-                    self.conn.execute(f'INSERT INTO join_requests ({", ".join(columns)}) VALUES ({placeholders})', row)
-            
-            self.conn.commit()
-            return True
-        except Exception as e:
-            self.conn.execute('ROLLBACK')
-            logger.error(f"خطأ في استعادة النسخة الاحتياطية: {e}")
-            return False
+    def create_broadcast(self, text, admin_chat_id):
+        cursor = self.conn.execute(
+            'INSERT INTO broadcasts (text, admin_chat_id) VALUES (?, ?)', (text, admin_chat_id)
+        )
+        broadcast_id = cursor.lastrowid
+        self.conn.execute('''
+            INSERT INTO broadcast_recipients (broadcast_id, user_id)
+            SELECT ?, user_id FROM users WHERE is_approved = 1
+        ''', (broadcast_id,))
+        self.conn.commit()
+        return broadcast_id
+
+    def get_broadcast(self, broadcast_id):
+        cursor = self.query(Broadcast, f'SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?', (broadcast_id,))
+        return cursor.fetchone()
+
+    def get_unfinished_broadcasts(self):
+        cursor = self.query(Broadcast, f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' ORDER BY id")
+        return cursor.fetchall()
+
+    def get_pending_recipients(self, broadcast_id, after_user_id=0, limit=100):
+        cursor = self.conn.execute('''
+            SELECT user_id FROM broadcast_recipients
+            WHERE broadcast_id = ? AND user_id > ? AND status = 'pending'
+            ORDER BY user_id LIMIT ?
+        ''', (broadcast_id, after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+    def mark_recipients(self, broadcast_id, results):
+        self.conn.executemany(
+            'UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND user_id = ?',
+            [(status, broadcast_id, user_id) for user_id, status in results]
+        )
+        self.conn.commit()
+
+    def get_broadcast_counts(self, broadcast_id):
+        cursor = self.conn.execute('''
+            SELECT status, COUNT(*) FROM broadcast_recipients
+            WHERE broadcast_id = ? GROUP BY status
+        ''', (broadcast_id,))
+        return dict(cursor.fetchall())
+
+    def finish_broadcast(self, broadcast_id):
+        self.conn.execute(
+            "UPDATE broadcasts SET status = 'done', finished_date = CURRENT_TIMESTAMP WHERE id = ?",
+            (broadcast_id,)
+        )
+        self.conn.commit()
 
-    def add_backup_record(self, backup_name, file_size, description=""):
+    def _insert_backup_record(self, backup_name, file_size, description, manifest, change_seq):
+        kind = manifest.get('kind', 'full')
         self.conn.execute('''
-            INSERT INTO backups (backup_name, file_size, description)
-            VALUES (?, ?, ?)
-        ''', (backup_name, file_size, description))
+            INSERT INTO backups (backup_name, file_size, description, kind, archive_id, parent_id, change_seq)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (backup_name, file_size, description, kind, manifest.get('archive_id'), manifest.get('parent_id'), change_seq))
+        if kind == 'full' and change_seq:
+            # النسخ التفاضلية القادمة تبدأ من هذه النسخة، فلا حاجة للتغييرات الأقدم
+            self.conn.execute('DELETE FROM change_log WHERE id <= ?', (change_seq,))
+
+    def add_backup_record(self, backup_name, file_size, description="", manifest=None):
+        manifest = manifest or {}
+        self._insert_backup_record(backup_name, file_size, description, manifest, manifest.get('change_seq'))
         self.conn.commit()
 
     def get_backup_history(self):
-        cursor = self.conn.execute('SELECT * FROM backups ORDER BY backup_date DESC LIMIT 10')
+        cursor = self.query(BackupRecord, f'SELECT {BACKUP_COLUMNS} FROM backups ORDER BY backup_date DESC LIMIT 10')
         return cursor.fetchall()
 
+class AsyncDatabase:
+    """واجهة غير متزامنة لـ Database حتى لا تعطل الاستعلامات حلقة الأحداث"""
+    # الكتابة على خيط واحد يملك اتصال الكتابة، والقراءة على مجموعة خيوط لكل منها اتصاله
+
+    # عمليات تعمل على الذاكرة فقط فتُنفذ مباشرة دون المرور بالطوابير
+    INLINE_METHODS = frozenset({
+        'update_user_activity', 'record_content_view', 'get_categories', 'get_category_by_id',
+        'get_category_id_by_name',
+    })
+
+    READ_METHODS = frozenset({
+        'get_setting', 'load_setting', 'get_all_settings', 'get_user', 'get_all_users',
+        'get_pending_requests', 'get_content_by_category', 'get_all_content',
+        'get_recent_content', 'get_content', 'get_content_page', 'search_content',
+        'create_backup', 'get_backup_history', 'get_broadcast', 'get_unfinished_broadcasts',
+        'get_pending_recipients', 'get_broadcast_counts', 'get_subscribed_user_ids', 'load_persistent_data',
+        'get_statistics', 'get_request_page', 'count_requests',
+    })
+
+    def __init__(self, database, readers=4):
+        self.db = database
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._reader_pool = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix='db-reader', initializer=database.open_reader
+        )
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+        if name in self.INLINE_METHODS:
+            async def inline(*args, **kwargs):
+                return method(*args, **kwargs)
+
+            setattr(self, name, inline)
+            return inline
+        executor = self._reader_pool if name in self.READ_METHODS else self._writer
+
+        async def call(*args, **kwargs):
+            return await self._run(executor, method, *args, **kwargs)
+
+        setattr(self, name, call)
+        return call
+
+    async def _run(self, executor, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(self._timed, method, *args, **kwargs))
+
+    @staticmethod
+    def _timed(method, *args, **kwargs):
+        # يُقاس داخل خيط قاعدة البيانات فلا يدخل فيه وقت الانتظار في الطابور
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            metrics.inc('bot_db_errors_total', method.__name__)
+            raise
+        finally:
+            metrics.observe('bot_db_seconds', method.__name__, time.perf_counter() - started)
+
+    async def get_setting(self, key):
+        # القراءة من النسخة المحفوظة في الذاكرة دون أي استعلام
+        value, hit = self.db.settings.get(key)
+        if hit:
+            return value
+        return await self._run(self._reader_pool, self.db.load_setting, key)
+
+    async def get_user(self, user_id):
+        # كل رسالة تقرأ حالة المستخدم، فالمستخدم النشط يُخدم من الذاكرة
+        user, hit = self.db.users.get(user_id)
+        if hit:
+            return user
+        generation = self.db.users.generation
+        user = await self._run(self._reader_pool, self.db.get_user, user_id)
+        self.db.users.put(user_id, user, generation)
+        return user
+
+    async def get_statistics(self, days=30):
+        # شاشة الإحصائيات تُفتح كثيراً والأرقام لا تحتاج دقة الثانية
+        stats, hit = self.db.statistics.get(days)
+        if hit:
+            return stats
+        stats = await self._run(self._reader_pool, self.db.get_statistics, days)
+        self.db.statistics.put(days, stats)
+        return stats
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._reader_pool.shutdown(wait=True)
+        self.db.close()
+
 db = Database()
+adb = AsyncDatabase(db, readers=int(os.getenv('DB_READERS', 4)))
+metrics.register_cache('settings', db.settings.stats)
+metrics.register_cache('statistics', db.statistics.stats)
+metrics.register_cache('users', db.users.stats)
+
+background_tasks = set()
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+class TokenBucket:
+    """محدد معدل الإرسال بأسلوب دلو الرموز، مع إيقاف مؤقت عند RetryAfter"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._resume_at = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._resume_at:
+                    await asyncio.sleep(self._resume_at - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        # تيليجرام يطلب التوقف عن الإرسال كلياً لمدة معينة
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+        self._tokens = 0
+
+# الحد العام لتيليجرام حوالي 30 رسالة في الثانية
+telegram_limiter = TokenBucket(float(os.getenv('TELEGRAM_RATE_LIMIT', 25)))
+
+class BroadcastEngine:
+    """إرسال البث الجماعي وإشعارات الطلبات في الخلفية مع حفظ حالة كل مستلم"""
+
+    # نوع البث: (رسالة التقدم، رسالة الانتهاء)
+    TITLES = {
+        'broadcast': ("📢 جاري البث الجماعي...", "✅ اكتمل البث الجماعي"),
+        'approval': ("📨 جاري إرسال إشعارات الموافقة...", "✅ اكتمل إرسال إشعارات الموافقة"),
+        'rejection': ("📨 جاري إرسال إشعارات الرفض...", "✅ اكتمل إرسال إشعارات الرفض"),
+    }
+
+    def __init__(self, limiter, concurrency=10, max_attempts=5, batch_size=100, progress_interval=5):
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._running = set()
+
+    def start(self, bot, broadcast_id):
+        if broadcast_id in self._running:
+            return
+        self._running.add(broadcast_id)
+        start_background_task(self.run(bot, broadcast_id))
+
+    async def run(self, bot, broadcast_id):
+        try:
+            broadcast = await adb.get_broadcast(broadcast_id)
+            kind = broadcast.kind or 'broadcast'
+            progress_title, done_title = self.TITLES[kind]
+            text, reply_markup = await self.compose(kind, broadcast.text)
+            admin_chat_id = broadcast.admin_chat_id
+            progress_message = await self._notify(bot, admin_chat_id, progress_title)
+            semaphore = asyncio.Semaphore(self.concurrency)
+            last_progress = time.monotonic()
+            after_user_id = 0
+
+            while True:
+                user_ids = await adb.get_pending_recipients(broadcast_id, after_user_id, self.batch_size)
+                if not user_ids:
+                    break
+                after_user_id = user_ids[-1]
+                results = []
+                try:
+                    await asyncio.gather(*(
+                        self._deliver(bot, semaphore, user_id, text, results, reply_markup) for user_id in user_ids
+                    ))
+                finally:
+                    # حفظ ما تم إرساله حتى لو أوقف البث في منتصف الدفعة
+                    if results:
+                        await adb.mark_recipients(broadcast_id, results)
+
+                if progress_message and time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    counts = await adb.get_broadcast_counts(broadcast_id)
+                    try:
+                        await progress_message.edit_text(f"{progress_title}\n\n{self.format_counts(counts)}")
+                    except Exception:
+                        pass
+
+            await adb.finish_broadcast(broadcast_id)
+            counts = await adb.get_broadcast_counts(broadcast_id)
+            await self._notify(bot, admin_chat_id, f"{done_title}\n\n{self.format_counts(counts)}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"خطأ في البث الجماعي {broadcast_id}: {e}")
+        finally:
+            self._running.discard(broadcast_id)
+
+    @staticmethod
+    async def compose(kind, text):
+        """نص الرسالة ولوحة الأزرار المرفقة بها حسب نوع البث"""
+        if kind == 'broadcast':
+            return f"*إشعار عام من الإدارة:*\n\n{text}", None
+        if kind == 'approval':
+            # الإعداد يُقرأ عند الإرسال حتى يبقى صحيحاً إذا استؤنف البث بعد تغييره
+            if await adb.get_setting('subscription_required') == '1':
+                subscription_message = await adb.get_setting('subscription_message')
+                subscription_channel = await adb.get_setting('subscription_channel')
+                return (
+                    f"{text}\n\n{subscription_message}\n\nالقناة: {subscription_channel}",
+                    await user_subscription_menu()
+                )
+            return f"{text}\n\nيمكنك الآن استخدام البوت.", user_main_menu()
+        return text, None
+
+    async def _deliver(self, bot, semaphore, user_id, text, results, reply_markup=None):
+        status = 'failed'
+        async with semaphore:
+            for attempt in range(self.max_attempts):
+                await self.limiter.acquire()
+                try:
+                    await bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+                    status = 'sent'
+                    break
+                except RetryAfter as e:
+                    self.limiter.pause(e.retry_after)
+                except Forbidden:
+                    status = 'blocked'
+                    break
+                except BadRequest:
+                    break
+                except NetworkError:
+                    if attempt + 1 < self.max_attempts:
+                        await asyncio.sleep(2 ** attempt)
+                except Exception as e:
+                    # أي خطأ آخر (مثل ChatMigrated) يخص هذا المستلم وحده ولا يوقف البث
+                    logger.error(f"خطأ في الإرسال إلى {user_id}: {e}")
+                    break
+        results.append((user_id, status))
+
+    async def _notify(self, bot, chat_id, text):
+        try:
+            return await bot.send_message(chat_id=chat_id, text=text)
+        except Exception as e:
+            logger.error(f"خطأ في إرسال تقرير البث: {e}")
+
+    @staticmethod
+    def format_counts(counts):
+        return (
+            f"✅ تم الإرسال: {counts.get('sent', 0)}\n"
+            f"🚫 حظروا البوت: {counts.get('blocked', 0)}\n"
+            f"❌ فشل: {counts.get('failed', 0)}\n"
+            f"⏳ متبقي: {counts.get('pending', 0)}"
+        )
+
+broadcast_engine = BroadcastEngine(
+    telegram_limiter, concurrency=int(os.getenv('BROADCAST_CONCURRENCY', 10))
+)
 
 def get_admin_id():
     return int(os.getenv('ADMIN_ID', 123456789))
@@ -369,41 +1878,179 @@ def get_admin_id():
 def is_admin(user_id):
     return user_id == get_admin_id()
 
-def get_category_id_by_name(name):
-    categories = db.get_categories()
-    for cat in categories:
-        if cat[1] == name:
-            return cat[0]
-    return None
+async def get_category_id_by_name(name):
+    return await adb.get_category_id_by_name(name)
+
+class SubscriptionCache:
+    """ذاكرة مؤقتة لحالة الاشتراك في القناة"""
+    # النتيجة الإيجابية تُحفظ مدة أطول، والطلبات المتزامنة لنفس المستخدم تنتظر استدعاءً واحداً
+
+    def __init__(self, positive_ttl=600, negative_ttl=15, max_entries=50000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def is_member(self, bot, channel, user_id, force=False):
+        key = (channel, user_id)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic() and (entry[1] or not force):
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(bot, channel, user_id))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot, channel, user_id):
+        chat_member = await bot.get_chat_member(f'@{channel}', user_id)
+        is_member = chat_member.status in ['member', 'administrator', 'creator']
+        self.store(channel, user_id, is_member)
+        return is_member
+
+    def store(self, channel, user_id, is_member):
+        if len(self._entries) >= self.max_entries:
+            now = time.monotonic()
+            self._entries = {key: entry for key, entry in self._entries.items() if entry[0] > now}
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._entries[(channel, user_id)] = (time.monotonic() + ttl, is_member)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+subscription_cache = SubscriptionCache(
+    positive_ttl=int(os.getenv('SUBSCRIPTION_CACHE_TTL', 600)),
+    negative_ttl=int(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', 15))
+)
+metrics.register_cache('subscription', subscription_cache.stats)
 
-def get_category_name_by_id(category_id):
-    category = db.get_category_by_id(category_id)
-    return category[1] if category else "غير معروف"
+def subscription_channel_name(subscription_channel):
+    # إزالة @ من اسم القناة إذا وجد
+    if not subscription_channel or subscription_channel == '@username':
+        return None
+    return subscription_channel.replace('@', '')
 
-async def check_subscription(user_id, context: CallbackContext):
+async def check_subscription(user_id, context: CallbackContext, force=False):
     """التحقق من اشتراك المستخدم في القناة"""
-    subscription_channel = db.get_setting('subscription_channel')
-    if not subscription_channel or subscription_channel == '@username':
+    channel = subscription_channel_name(await adb.get_setting('subscription_channel'))
+    if not channel:
         return True
     
     try:
-        # إزالة @ من اسم القناة إذا وجد
-        channel = subscription_channel.replace('@', '')
-        chat_member = await context.bot.get_chat_member(f'@{channel}', user_id)
-        return chat_member.status in ['member', 'administrator', 'creator']
+        return await subscription_cache.is_member(context.bot, channel, user_id, force)
     except Exception as e:
         logger.error(f"خطأ في التحقق من الاشتراك: {e}")
         return False
 
+async def subscription_rechecker(bot, interval=21600, batch_size=200):
+    """إعادة التحقق دورياً من المشتركين وإلغاء اشتراك من غادر القناة"""
+    while True:
+        await asyncio.sleep(interval)
+        channel = subscription_channel_name(await adb.get_setting('subscription_channel'))
+        if not channel or await adb.get_setting('subscription_required') != '1':
+            continue
+
+        after_user_id = 0
+        removed = 0
+        while True:
+            user_ids = await adb.get_subscribed_user_ids(after_user_id, batch_size)
+            if not user_ids:
+                break
+            after_user_id = user_ids[-1]
+            left = []
+            for user_id in user_ids:
+                await telegram_limiter.acquire()
+                try:
+                    chat_member = await bot.get_chat_member(f'@{channel}', user_id)
+                except RetryAfter as e:
+                    telegram_limiter.pause(e.retry_after)
+                    continue
+                except Exception:
+                    # الأخطاء لا تعني أن المستخدم غادر القناة
+                    continue
+                if chat_member.status in ['left', 'kicked']:
+                    left.append(user_id)
+                    subscription_cache.store(channel, user_id, False)
+            if left:
+                await adb.mark_users_unsubscribed(left)
+                removed += len(left)
+        if removed:
+            logger.info(f"تم إلغاء اشتراك {removed} مستخدم غادروا القناة")
+
+markup_cache = MarkupCache()
+metrics.register_cache('markup', markup_cache.stats)
+metrics.register_cache('content', db.payloads.stats)
+
+# رسالة المحتوى كما تُرسل: نوعها، ومعرف الملف للصور والفيديو، والنص أو الوصف
+ContentPayload = namedtuple('ContentPayload', ['content_type', 'file_id', 'text', 'title'])
+
+def content_payload(content):
+    if content.content_type == 'text':
+        text = f"📖 {content.title}\n\n{content.content}\n\n---\nنهاية المحتوى 📚"
+    elif content.content_type == 'photo':
+        text = f"📸 {content.title}\n\n{content.content}"
+    else:
+        text = f"🎥 {content.title}\n\n{content.content}"
+    return ContentPayload(content.content_type, content.file_id, text, content.title)
+
+async def get_content_payload(content_id):
+    # حذف المحتوى أو الأقسام والاستعادة تحذف الرسائل المخزنة في Database
+    payload, hit = db.payloads.get(content_id)
+    if hit:
+        return payload
+
+    generation = db.payloads.generation
+    content = await adb.get_content(content_id)
+    if not content:
+        return None
+    payload = content_payload(content)
+    db.payloads.put(content_id, payload, generation)
+    return payload
+
+CONTENT_PAGE_SIZE = int(os.getenv('CONTENT_PAGE_SIZE', 10))
+ADMIN_CONTENT_PAGE_SIZE = 15
+REQUESTS_PAGE_SIZE = 20
+# نطاقات القبول والرفض الجماعي: (الوصف، شرط اختيار الطلبات)
+BULK_SCOPES = {
+    'page': ("طلبات هذه الصفحة", None),
+    'd1': ("الطلبات الأقدم من يوم", {'older_than_days': 1}),
+    'd7': ("الطلبات الأقدم من أسبوع", {'older_than_days': 7}),
+    'all': ("جميع الطلبات", {}),
+}
+
+def page_navigation(prefix, rows, has_prev, has_next):
+    """أزرار التنقل بين الصفحات، والمؤشر هو (created_date, id) لأول أو آخر عنصر في الصفحة"""
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=f"{prefix}_p_{rows[0].id}_{rows[0].created_date}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"{prefix}_n_{rows[-1].id}_{rows[-1].created_date}"))
+    return nav
+
+def parse_page_cursor(direction, content_id, created_date):
+    return ('prev' if direction == 'p' else 'next'), (created_date, int(content_id))
+
+@functools.lru_cache(maxsize=None)
 def user_main_menu():
     keyboard = [
         [KeyboardButton("📁 الاقسام"), KeyboardButton("📚 آخر القصص")],
+        [KeyboardButton("🔎 بحث")],
         [KeyboardButton("ℹ️ حول البوت"), KeyboardButton("📞 اتصل بنا")]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-def user_subscription_menu():
-    subscription_channel = db.get_setting('subscription_channel')
+async def user_subscription_menu():
+    return build_user_subscription_menu(await adb.get_setting('subscription_channel'))
+
+@functools.lru_cache(maxsize=8)
+def build_user_subscription_menu(subscription_channel):
     keyboard = [
         [InlineKeyboardButton("📢 انضم إلى القناة", url=f"https://t.me/{subscription_channel.replace('@', '')}")],
         [InlineKeyboardButton("✅ تحقق من الاشتراك", callback_data="check_subscription")],
@@ -411,51 +2058,146 @@ def user_subscription_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def user_categories_menu():
-    categories = db.get_categories()
+@functools.lru_cache(maxsize=None)
+def user_pending_menu():
+    return ReplyKeyboardMarkup([[KeyboardButton("🔄 تحديث الحالة")]], resize_keyboard=True)
+
+async def user_categories_menu():
+    version = db.catalog_version
+    markup, hit = markup_cache.get('user_categories', version)
+    if hit:
+        return markup
+
+    categories = await adb.get_categories()
     keyboard = []
     row = []
     for i, cat in enumerate(categories):
-        row.append(KeyboardButton(cat[1]))
+        row.append(KeyboardButton(cat.name))
         if len(row) == 2 or i == len(categories) - 1:
             keyboard.append(row)
             row = []
     keyboard.append([KeyboardButton("🏠 الرئيسية")])
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    markup_cache.put('user_categories', version, markup)
+    return markup
+
+async def user_content_menu(category_name, category_id, cursor=None, direction='next'):
+    """صفحة من محتوى القسم، أو None إذا كانت الصفحة فارغة"""
+    key = ('user_content', category_id, cursor, direction)
+    version = db.catalog_version
+    markup, hit = markup_cache.get(key, version)
+    if hit:
+        return markup
+
+    content_items, has_prev, has_next = await adb.get_content_page(
+        category_id, cursor, direction, CONTENT_PAGE_SIZE
+    )
+    if content_items:
+        keyboard = []
+        
+        for content in content_items:
+            short_title = content.title[:20] + "..." if len(content.title) > 20 else content.title
+            keyboard.append([InlineKeyboardButton(f"📄 {short_title}", callback_data=f"content_{content.id}")])
+        
+        nav = page_navigation(f"cpage_{category_id}", content_items, has_prev, has_next)
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="back_to_categories")])
+        
+        markup = InlineKeyboardMarkup(keyboard)
+    markup_cache.put(key, version, markup)
+    return markup
+
+async def user_recent_content_menu():
+    """قائمة آخر القصص، أو None إذا لم يكن هناك محتوى"""
+    version = db.catalog_version
+    markup, hit = markup_cache.get('user_recent_content', version)
+    if hit:
+        return markup
+
+    recent_content = await adb.get_recent_content(7)
+    if recent_content:
+        keyboard = []
+        
+        for content in recent_content:
+            short_title = content.title[:20] + "..." if len(content.title) > 20 else content.title
+            keyboard.append([InlineKeyboardButton(f"📄 {short_title}", callback_data=f"content_{content.id}")])
+        
+        keyboard.append([InlineKeyboardButton("🏠 الرئيسية", callback_data="back_to_main")])
+        
+        markup = InlineKeyboardMarkup(keyboard)
+    markup_cache.put('user_recent_content', version, markup)
+    return markup
 
-def user_content_menu(category_name, category_id):
-    content_items = db.get_content_by_category(category_id)
-    keyboard = []
-    
-    for content in content_items:
-        short_title = content[1][:20] + "..." if len(content[1]) > 20 else content[1]
-        keyboard.append([InlineKeyboardButton(f"📄 {short_title}", callback_data=f"content_{content[0]}")])
-    
-    keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="back_to_categories")])
-    
-    return InlineKeyboardMarkup(keyboard)
+async def user_search_results(search_text, offset=0):
+    """نص وأزرار صفحة من نتائج البحث، أو None إذا لم توجد نتائج"""
+    results, has_next = await adb.search_content(search_text, offset, CONTENT_PAGE_SIZE)
+    if not results:
+        return None
 
-def user_recent_content_menu():
-    recent_content = db.get_recent_content(7)
+    lines = [f"🔎 نتائج البحث عن: {search_text}\n"]
     keyboard = []
-    
-    for content in recent_content:
-        short_title = content[1][:20] + "..." if len(content[1]) > 20 else content[1]
-        keyboard.append([InlineKeyboardButton(f"📄 {short_title}", callback_data=f"content_{content[0]}")])
-    
+    for number, (content_id, title, snippet) in enumerate(results, start=offset + 1):
+        lines.append(f"{number}. {title}\n{snippet}\n")
+        short_title = title[:20] + "..." if len(title) > 20 else title
+        keyboard.append([InlineKeyboardButton(f"📄 {short_title}", callback_data=f"content_{content_id}")])
+
+    nav = []
+    if offset:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=f"spage_{max(offset - CONTENT_PAGE_SIZE, 0)}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"spage_{offset + CONTENT_PAGE_SIZE}"))
+    if nav:
+        keyboard.append(nav)
     keyboard.append([InlineKeyboardButton("🏠 الرئيسية", callback_data="back_to_main")])
-    
-    return InlineKeyboardMarkup(keyboard)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
 
+async def join_requests_page(offset=0):
+    """نص وأزرار صفحة من طلبات الانضمام مع معرفات طلباتها، أو None إذا لم توجد طلبات"""
+    requests, total = await adb.get_request_page(offset, REQUESTS_PAGE_SIZE)
+    if not requests:
+        return None
+
+    req_text = f"📩 طلبات الانضمام ({offset + 1}-{offset + len(requests)} من {total}):\n\n"
+    for req in requests:
+        req_text += f"🆔 {req.user_id} - 👤 {req.first_name} - 📱 @{req.username or 'لا يوجد'} - 🕒 {req.request_date}\n"
+
+    keyboard = [
+        [InlineKeyboardButton("✅ قبول الصفحة", callback_data="bulk_page_approve"),
+         InlineKeyboardButton("❌ رفض الصفحة", callback_data="bulk_page_reject")],
+        [InlineKeyboardButton("✅ الأقدم من يوم", callback_data="bulk_d1_approve"),
+         InlineKeyboardButton("✅ الأقدم من أسبوع", callback_data="bulk_d7_approve")],
+        [InlineKeyboardButton("✅ قبول الكل", callback_data="bulk_all_approve"),
+         InlineKeyboardButton("❌ رفض الكل", callback_data="bulk_all_reject")],
+    ]
+    nav = []
+    if offset:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=f"reqpage_{max(offset - REQUESTS_PAGE_SIZE, 0)}"))
+    if offset + len(requests) < total:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"reqpage_{offset + REQUESTS_PAGE_SIZE}"))
+    if nav:
+        keyboard.append(nav)
+    return req_text, InlineKeyboardMarkup(keyboard), [req.user_id for req in requests]
+
+def bulk_request_filter(scope, context):
+    # نطاق الصفحة يستخدم الطلبات التي عُرضت على المدير فعلاً لا الصفحة الحالية في الجدول
+    label, request_filter = BULK_SCOPES[scope]
+    if request_filter is None:
+        request_filter = {'user_ids': context.user_data.get('request_page', [])}
+    return label, request_filter
+
+@functools.lru_cache(maxsize=None)
 def admin_main_menu():
     keyboard = [
         [KeyboardButton("👥 إدارة المستخدمين"), KeyboardButton("📁 إدارة الأقسام")],
         [KeyboardButton("📦 إدارة المحتوى"), KeyboardButton("⚙️ إعدادات البوت")],
-        [KeyboardButton("📊 الإحصائيات"), KeyboardButton("📢 البث الجماعي")],
-        [KeyboardButton("💾 النسخ الاحتياطي"), KeyboardButton("🔙 وضع المستخدم")]
+        [KeyboardButton("📊 الإحصائيات"), KeyboardButton("📈 الأداء")],
+        [KeyboardButton("📢 البث الجماعي"), KeyboardButton("💾 النسخ الاحتياطي")],
+        [KeyboardButton("🔙 وضع المستخدم")]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@functools.lru_cache(maxsize=None)
 def admin_users_menu():
     keyboard = [
         [KeyboardButton("📋 عرض المستخدمين"), KeyboardButton("⏳ طلبات الانضمام")],
@@ -463,6 +2205,7 @@ def admin_users_menu():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@functools.lru_cache(maxsize=None)
 def admin_categories_menu():
     keyboard = [
         [KeyboardButton("➕ إضافة قسم"), KeyboardButton("✏️ تعديل قسم")],
@@ -471,6 +2214,7 @@ def admin_categories_menu():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@functools.lru_cache(maxsize=None)
 def admin_content_menu():
     keyboard = [
         [KeyboardButton("➕ إضافة محتوى"), KeyboardButton("🗑 حذف محتوى")],
@@ -478,6 +2222,7 @@ def admin_content_menu():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@functools.lru_cache(maxsize=None)
 def admin_settings_menu():
     keyboard = [
         [KeyboardButton("✏️ رسالة الترحيب"), KeyboardButton("📝 حول البوت")],
@@ -487,8 +2232,12 @@ def admin_settings_menu():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-def admin_subscription_menu():
-    subscription_status = "✅ مفعل" if db.get_setting('subscription_required') == '1' else "❌ معطل"
+async def admin_subscription_menu():
+    return build_admin_subscription_menu(await adb.get_setting('subscription_required') == '1')
+
+@functools.lru_cache(maxsize=2)
+def build_admin_subscription_menu(subscription_required):
+    subscription_status = "✅ مفعل" if subscription_required else "❌ معطل"
     keyboard = [
         [KeyboardButton(f"🔧 حالة الاشتراك: {subscription_status}")],
         [KeyboardButton("✏️ رسالة الاشتراك"), KeyboardButton("🔗 رابط القناة")],
@@ -496,59 +2245,107 @@ def admin_subscription_menu():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@functools.lru_cache(maxsize=None)
 def admin_backup_menu():
     keyboard = [
-        [KeyboardButton("📥 تنزيل نسخة"), KeyboardButton("📤 رفع نسخة")],
-        [KeyboardButton("📋 سجل النسخ"), KeyboardButton("🔧 إعدادات النسخ")],
-        [KeyboardButton("🔙 لوحة التحكم")]
+        [KeyboardButton("📥 تنزيل نسخة"), KeyboardButton("🧩 نسخة تفاضلية")],
+        [KeyboardButton("📤 رفع نسخة"), KeyboardButton("📋 سجل النسخ")],
+        [KeyboardButton("🔧 إعدادات النسخ"), KeyboardButton("🔙 لوحة التحكم")]
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+@functools.lru_cache(maxsize=None)
+def admin_content_type_menu():
+    keyboard = [
+        [KeyboardButton("📝 نص"), KeyboardButton("📸 صورة")],
+        [KeyboardButton("🎥 فيديو"), KeyboardButton("🔙 إدارة المحتوى")]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-def admin_categories_list():
-    categories = db.get_categories()
+async def admin_category_picker():
+    version = db.catalog_version
+    markup, hit = markup_cache.get('admin_category_picker', version)
+    if hit:
+        return markup
+
+    categories = await adb.get_categories()
     keyboard = []
     for cat in categories:
-        keyboard.append([InlineKeyboardButton(cat[1], callback_data=f"delete_cat_{cat[0]}")])
-    keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel_delete")])
-    return InlineKeyboardMarkup(keyboard)
-
-def admin_content_list():
-    content_items = db.get_all_content()
+        keyboard.append([KeyboardButton(cat.name)])
+    keyboard.append([KeyboardButton("🔙 إدارة المحتوى")])
+    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    markup_cache.put('admin_category_picker', version, markup)
+    return markup
+
+async def admin_categories_list():
+    version = db.catalog_version
+    markup, hit = markup_cache.get('admin_categories_list', version)
+    if hit:
+        return markup
+
+    categories = await adb.get_categories()
     keyboard = []
-    for content in content_items[:15]:
-        short_title = content[1][:15] + "..." if len(content[1]) > 15 else content[1]
-        keyboard.append([InlineKeyboardButton(f"🗑 {short_title}", callback_data=f"delete_content_{content[0]}")])
+    for cat in categories:
+        keyboard.append([InlineKeyboardButton(cat.name, callback_data=f"delete_cat_{cat.id}")])
     keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel_delete")])
-    return InlineKeyboardMarkup(keyboard)
-
-async def create_and_send_backup(update: Update, context: CallbackContext):
+    markup = InlineKeyboardMarkup(keyboard)
+    markup_cache.put('admin_categories_list', version, markup)
+    return markup
+
+async def admin_content_list(cursor=None, direction='next'):
+    """صفحة من قائمة حذف المحتوى، أو None إذا كانت الصفحة فارغة"""
+    key = ('admin_content_list', cursor, direction)
+    version = db.catalog_version
+    markup, hit = markup_cache.get(key, version)
+    if hit:
+        return markup
+
+    content_items, has_prev, has_next = await adb.get_content_page(
+        None, cursor, direction, ADMIN_CONTENT_PAGE_SIZE
+    )
+    if content_items:
+        keyboard = []
+        for content in content_items:
+            short_title = content.title[:15] + "..." if len(content.title) > 15 else content.title
+            keyboard.append([InlineKeyboardButton(f"🗑 {short_title}", callback_data=f"delete_content_{content.id}")])
+        nav = page_navigation("apage", content_items, has_prev, has_next)
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel_delete")])
+        markup = InlineKeyboardMarkup(keyboard)
+    markup_cache.put(key, version, markup)
+    return markup
+
+async def create_and_send_backup(update: Update, context: CallbackContext, incremental=False):
+    # النسخة تُكتب في ملف مؤقت على القرص ثم تُرفع منه
+    backup_file = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
     try:
-        backup_data = db.create_backup()
-        json_data = json.dumps(backup_data, ensure_ascii=False, indent=2)
-        
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            zip_file.writestr('backup_data.json', json_data)
-        
-        zip_buffer.seek(0)
+        with backup_file:
+            manifest = await adb.create_backup(backup_file, incremental)
+        file_size = os.path.getsize(backup_file.name)
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"bot_backup_{timestamp}.Mkfrky"
-        
-        if isinstance(update, Update) and update.message:
-            await update.message.reply_document(
-                document=zip_buffer,
-                filename=filename,
-                caption=f"📦 النسخة الاحتياطية للبوت\n\n✅ تم إنشاء النسخة في: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n🔐 كلمة السر: {db.get_setting('backup_password')}"
-            )
+        if manifest['kind'] == 'delta':
+            filename = f"bot_backup_{timestamp}_delta.Mkfrky"
+            backup_kind = "🧩 نسخة تفاضلية (تتطلب استعادة النسخ السابقة في السلسلة أولاً)"
+            description = "نسخة احتياطية تفاضلية"
         else:
-            await update.callback_query.message.reply_document(
-                document=zip_buffer,
-                filename=filename,
-                caption=f"📦 النسخة الاحتياطية للبوت\n\n✅ تم إنشاء النسخة في: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n🔐 كلمة السر: {db.get_setting('backup_password')}"
-            )
+            filename = f"bot_backup_{timestamp}.Mkfrky"
+            backup_kind = "📦 نسخة كاملة"
+            description = "نسخة احتياطية تلقائية"
+        caption = (
+            f"📦 النسخة الاحتياطية للبوت\n\n{backup_kind}\n"
+            f"✅ تم إنشاء النسخة في: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"🔐 كلمة السر: {await adb.get_setting('backup_password')}"
+        )
         
-        db.add_backup_record(filename, len(zip_buffer.getvalue()), "نسخة احتياطية تلقائية")
+        with open(backup_file.name, 'rb') as document:
+            if isinstance(update, Update) and update.message:
+                await update.message.reply_document(document=document, filename=filename, caption=caption)
+            else:
+                await update.callback_query.message.reply_document(document=document, filename=filename, caption=caption)
+        
+        await adb.add_backup_record(filename, file_size, description, manifest)
         
     except Exception as e:
         error_msg = f"❌ خطأ في إنشاء النسخة الاحتياطية: {str(e)}"
@@ -556,33 +2353,40 @@ async def create_and_send_backup(update: Update, context: CallbackContext):
             await update.message.reply_text(error_msg)
         else:
             await update.callback_query.message.reply_text(error_msg)
+    finally:
+        os.remove(backup_file.name)
 
 async def restore_backup_from_file(update: Update, context: CallbackContext, file):
+    # تنزيل الملف إلى القرص ثم قراءته بشكل متدفق أثناء الاستعادة
+    fd, backup_path = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
     try:
         file_obj = await context.bot.get_file(file.file_id)
-        file_content = await file_obj.download_as_bytearray()
+        await file_obj.download_to_drive(custom_path=backup_path)
         
-        zip_buffer = io.BytesIO(file_content)
-        with zipfile.ZipFile(zip_buffer, 'r') as zip_file:
-            json_data = zip_file.read('backup_data.json').decode('utf-8')
-            backup_data = json.loads(json_data)
-        
-        success = db.restore_backup(backup_data)
+        manifest, counts = await adb.restore_backup_archive(
+            backup_path, file.file_name, os.path.getsize(backup_path)
+        )
         
-        if success:
+        if manifest.get('kind') == 'delta':
             await update.message.reply_text(
-                f"✅ تم استعادة النسخة الاحتياطية بنجاح!\n\n"
-                f"📅 تاريخ النسخة: {backup_data.get('timestamp', 'غير معروف')}\n"
-                f"👥 المستخدمون: {len(backup_data.get('users', {}).get('data', []))}\n"
-                f"📁 الأقسام: {len(backup_data.get('categories', {}).get('data', []))}\n"
-                f"📦 المحتوى: {len(backup_data.get('content', {}).get('data', []))}",
+                f"✅ تم تطبيق النسخة التفاضلية بنجاح!\n\n"
+                f"📅 تاريخ النسخة: {manifest.get('timestamp') or 'غير معروف'}\n"
+                f"👥 المستخدمون المحدثون: {counts.get('users', 0)}\n"
+                f"📁 الأقسام المحدثة: {counts.get('categories', 0)}\n"
+                f"📦 المحتوى المحدث: {counts.get('content', 0)}\n"
+                f"🗑 السجلات المحذوفة: {counts.get('deleted', 0)}",
                 reply_markup=admin_main_menu()
             )
-            
-            filename = file.file_name
-            db.add_backup_record(filename, len(file_content), "استعادة نسخة احتياطية")
         else:
-            await update.message.reply_text("❌ فشل في استعادة النسخة الاحتياطية")
+            await update.message.reply_text(
+                f"✅ تم استعادة النسخة الاحتياطية بنجاح!\n\n"
+                f"📅 تاريخ النسخة: {manifest.get('timestamp') or 'غير معروف'}\n"
+                f"👥 المستخدمون: {counts.get('users', 0)}\n"
+                f"📁 الأقسام: {counts.get('categories', 0)}\n"
+                f"📦 المحتوى: {counts.get('content', 0)}",
+                reply_markup=admin_main_menu()
+            )
             
     except zipfile.BadZipFile:
         await update.message.reply_text("❌ الملف ليس نسخة احتياطية صالحة")
@@ -590,51 +2394,109 @@ async def restore_backup_from_file(update: Update, context: CallbackContext, fil
         await update.message.reply_text("❌ الملف لا يحتوي على بيانات نسخ احتياطي صالحة")
     except Exception as e:
         await update.message.reply_text(f"❌ خطأ في استعادة النسخة الاحتياطية: {str(e)}")
+    finally:
+        os.remove(backup_path)
 
 async def show_backup_history(update: Update, context: CallbackContext):
-    backups = db.get_backup_history()
+    backups = await adb.get_backup_history()
     
     if backups:
         history_text = "📋 سجل النسخ الاحتياطية:\n\n"
         for backup in backups:
-            date = backup[3].split()[0] if backup[3] else "غير معروف"
-            size_kb = backup[4] / 1024 if backup[4] else 0
-            history_text += f"📁 {backup[1]}\n"
+            date = backup.backup_date.split()[0] if backup.backup_date else "غير معروف"
+            size_kb = backup.file_size / 1024 if backup.file_size else 0
+            kind_icon = "🧩" if backup.kind == 'delta' else "📁"
+            history_text += f"{kind_icon} {backup.backup_name}\n"
             history_text += f"📅 {date} | 📊 {size_kb:.1f} KB\n"
-            if backup[5]:
-                history_text += f"📝 {backup[5]}\n"
+            if backup.description:
+                history_text += f"📝 {backup.description}\n"
             history_text += "─" * 30 + "\n"
     else:
         history_text = "⚠️ لا توجد نسخ احتياطية سابقة"
     
-    if hasattr(update, 'callback_query'):
+    if update.callback_query:
         await update.callback_query.message.reply_text(history_text)
     else:
         await update.message.reply_text(history_text)
 
 async def show_statistics(update: Update, context: CallbackContext):
-    total_users = len(db.get_all_users())
-    active_users = len(db.get_active_users(30))
-    total_content = len(db.get_all_content())
-    total_categories = len(db.get_categories())
-    
+    stats = await adb.get_statistics(30)
+
     stats_text = f"📊 إحصائيات البوت:\n\n"
-    stats_text += f"👥 المستخدمون: {total_users}\n"
-    stats_text += f"🎯 النشطون: {active_users}\n"
-    stats_text += f"📦 المحتوى: {total_content}\n"
-    stats_text += f"📁 الأقسام: {total_categories}"
-    
+    stats_text += f"👥 المستخدمون: {stats['total_users']}\n"
+    stats_text += f"🎯 النشطون: {stats['active_users']}\n"
+    stats_text += f"📦 المحتوى: {stats['total_content']}\n"
+    stats_text += f"📁 الأقسام: {stats['total_categories']}\n\n"
+
+    stats_text += f"☀️ نشطون اليوم: {stats['daily_active']}\n"
+    stats_text += f"🆕 جدد اليوم: {stats['new_today']} | هذا الأسبوع: {stats['new_week']}\n"
+    stats_text += f"✅ مشتركون في القناة: {stats['subscribed']}\n"
+    stats_text += f"⏳ طلبات معلقة: {stats['pending_requests']}\n"
+    stats_text += f"👁 المشاهدات: {stats['total_views']}\n"
+
+    if stats['per_category']:
+        stats_text += "\n📁 المحتوى حسب القسم:\n"
+        # أكبر الأقسام فقط حتى لا تتجاوز الرسالة حد Telegram
+        for name, count in sorted(stats['per_category'], key=lambda item: -item[1])[:15]:
+            stats_text += f"• {name}: {count}\n"
+
+    if stats['top_content']:
+        stats_text += "\n🔥 الأكثر مشاهدة:\n"
+        for title, views in stats['top_content']:
+            stats_text += f"• {title}: {views}\n"
+
     await update.message.reply_text(stats_text)
 
+def format_seconds(seconds):
+    if seconds == float('inf'):
+        return f">{LatencyHistogram.BUCKETS[-1]}s"
+    if seconds < 0.01:
+        return f"{seconds * 1000:.1f}ms"
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.1f}s"
+
+async def show_performance(update: Update, context: CallbackContext):
+    perf_text = "📈 أداء البوت:\n\n⏱ المعالجات (العدد | p50 | p95):\n"
+    for label, count, total, p50, p95 in metrics.summary('bot_handler_seconds'):
+        errors = metrics.counter('bot_handler_errors_total', label)
+        perf_text += f"• {label}: {count} | {format_seconds(p50)} | {format_seconds(p95)}"
+        perf_text += f" | ❌ {errors}\n" if errors else "\n"
+
+    perf_text += "\n🗄 قاعدة البيانات (الأكثر وقتاً):\n"
+    for label, count, total, p50, p95 in metrics.summary('bot_db_seconds')[:8]:
+        perf_text += f"• {label}: {count} | p95 {format_seconds(p95)} | المجموع {format_seconds(total)}\n"
+
+    perf_text += "\n🌐 Telegram API:\n"
+    for label, count, total, p50, p95 in metrics.summary('bot_telegram_seconds')[:8]:
+        errors = metrics.counter('bot_telegram_errors_total', label)
+        perf_text += f"• {label}: {count} | p50 {format_seconds(p50)} | p95 {format_seconds(p95)} | ❌ {errors}\n"
+
+    perf_text += "\n💾 الكاش (نسبة الإصابة):\n"
+    for cache, stats in metrics.cache_stats().items():
+        requests = stats['hits'] + stats['misses']
+        ratio = f"{stats['hits'] * 100 / requests:.0f}%" if requests else "-"
+        perf_text += f"• {cache}: {ratio} ({stats['hits']}/{requests}) | الحجم {stats['size']}\n"
+
+    hot_content = db.payloads.hot()
+    if hot_content:
+        perf_text += "\n🔥 المحتوى الأكثر طلباً من الكاش:\n"
+        for content_id, title, hits in hot_content:
+            perf_text += f"• {title} (ID: {content_id}): {hits}\n"
+
+    await update.message.reply_text(perf_text)
+
+@timed_handler
 async def start(update: Update, context: CallbackContext) -> None:
+    await welcome_user(update, context)
+
+async def welcome_user(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
     user_id = user.id
     
     context.user_data.clear()
-    db.update_user_activity(user_id)
+    await adb.update_user_activity(user_id)
     
     # التحقق أولاً إذا كان المستخدم موجوداً ومقبولاً
-    existing_user = db.get_user(user_id)
+    existing_user = await adb.get_user(user_id)
     
     if existing_user:
         # المستخدم موجود في النظام
@@ -645,21 +2507,21 @@ async def start(update: Update, context: CallbackContext) -> None:
             )
             return
         
-        if existing_user[4] == 1:  # المستخدم مقبول
-            subscription_required = db.get_setting('subscription_required') == '1'
+        if existing_user.is_approved == 1:  # المستخدم مقبول
+            subscription_required = await adb.get_setting('subscription_required') == '1'
             
             # التحقق من الاشتراك إذا كان مطلوباً
-            if subscription_required and existing_user[9] == 0:
-                subscription_message = db.get_setting('subscription_message')
-                subscription_channel = db.get_setting('subscription_channel')
+            if subscription_required and existing_user.has_subscribed == 0:
+                subscription_message = await adb.get_setting('subscription_message')
+                subscription_channel = await adb.get_setting('subscription_channel')
                 
                 await update.message.reply_text(
                     f"{subscription_message}\n\nالقناة: {subscription_channel}",
-                    reply_markup=user_subscription_menu()
+                    reply_markup=await user_subscription_menu()
                 )
                 return
             
-            welcome_message = db.get_setting('welcome_message')
+            welcome_message = await adb.get_setting('welcome_message')
             await update.message.reply_text(
                 f"{welcome_message}\n\nمرحباً بك مرة أخرى {user.first_name}! 👋",
                 reply_markup=user_main_menu()
@@ -669,7 +2531,7 @@ async def start(update: Update, context: CallbackContext) -> None:
             # المستخدم موجود لكن غير مقبول
             await update.message.reply_text(
                 "⏳ لا يزال طلبك قيد المراجعة...",
-                reply_markup=ReplyKeyboardMarkup([[KeyboardButton("🔄 تحديث الحالة")]], resize_keyboard=True)
+                reply_markup=user_pending_menu()
             )
             return
     
@@ -681,59 +2543,29 @@ async def start(update: Update, context: CallbackContext) -> None:
         )
         return
     
-    db.add_user(user_id, user.username, user.first_name, user.last_name)
+    # التسجيل وتطبيق سياسة القبول وطلب الانضمام في معاملة واحدة
+    user_data = await adb.register_user(user_id, user.username, user.first_name, user.last_name)
     
-    user_data = db.get_user(user_id)
-    auto_approve = db.get_setting('auto_approve') == '1'
-    approval_required = db.get_setting('approval_required') == '1'
-    
-    if auto_approve and not user_data[4]:
-        db.approve_user(user_id)
-        user_data = db.get_user(user_id)
-    
-    if user_data and user_data[4] == 1:
-        subscription_required = db.get_setting('subscription_required') == '1'
+    if user_data.is_approved == 1:
+        subscription_required = await adb.get_setting('subscription_required') == '1'
         
         # التحقق من الاشتراك إذا كان مطلوباً
-        if subscription_required and user_data[9] == 0:
-            subscription_message = db.get_setting('subscription_message')
-            subscription_channel = db.get_setting('subscription_channel')
+        if subscription_required and user_data.has_subscribed == 0:
+            subscription_message = await adb.get_setting('subscription_message')
+            subscription_channel = await adb.get_setting('subscription_channel')
             
             await update.message.reply_text(
                 f"{subscription_message}\n\nالقناة: {subscription_channel}",
-                reply_markup=user_subscription_menu()
+                reply_markup=await user_subscription_menu()
             )
             return
         
-        welcome_message = db.get_setting('welcome_message')
+        welcome_message = await adb.get_setting('welcome_message')
         await update.message.reply_text(
             f"اهلا وسهلا {user.first_name} 👋\n\n{welcome_message}",
             reply_markup=user_main_menu()
         )
-    elif not approval_required:
-        db.approve_user(user_id)
-        
-        subscription_required = db.get_setting('subscription_required') == '1'
-        if subscription_required:
-            subscription_message = db.get_setting('subscription_message')
-            subscription_channel = db.get_setting('subscription_channel')
-            
-            await update.message.reply_text(
-                f"{subscription_message}\n\nالقناة: {subscription_channel}",
-                reply_markup=user_subscription_menu()
-            )
-            return
-        
-        welcome_message = db.get_setting('welcome_message')
-        await update.message.reply_text(
-        f"اهلا وسهلا {user.first_name} 👋\n\n{welcome_message}",
-            reply_markup=user_main_menu()
-        )
     else:
-        db.conn.execute('INSERT OR REPLACE INTO join_requests (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)',
-                       (user_id, user.username, user.first_name, user.last_name))
-        db.conn.commit()
-        
         admin_id = get_admin_id()
         keyboard = [
             [InlineKeyboardButton("✅ الموافقة", callback_data=f"approve_{user_id}"),
@@ -751,9 +2583,10 @@ async def start(update: Update, context: CallbackContext) -> None:
         
         await update.message.reply_text(
             "📋 تم إرسال طلب انضمامك إلى المدير. انتظر الموافقة.",
-            reply_markup=ReplyKeyboardMarkup([[KeyboardButton("🔄 تحديث الحالة")]], resize_keyboard=True)
+            reply_markup=user_pending_menu()
         )
 
+@timed_handler
 async def handle_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
     await query.answer()
@@ -767,22 +2600,22 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
             return
             
         target_user_id = int(data.split('_')[1])
-        db.approve_user(target_user_id)
+        await adb.approve_user(target_user_id)
         
         try:
             # إرسال رسالة للمستخدم بأنه تمت الموافقته
-            user_data = db.get_user(target_user_id)
+            user_data = await adb.get_user(target_user_id)
             if user_data:
-                subscription_required = db.get_setting('subscription_required') == '1'
+                subscription_required = await adb.get_setting('subscription_required') == '1'
                 
                 if subscription_required:
-                    subscription_message = db.get_setting('subscription_message')
-                    subscription_channel = db.get_setting('subscription_channel')
+                    subscription_message = await adb.get_setting('subscription_message')
+                    subscription_channel = await adb.get_setting('subscription_channel')
                     
                     await context.bot.send_message(
                         chat_id=target_user_id,
                         text=f"🎉 تمت الموافقة على طلبك!\n\n{subscription_message}\n\nالقناة: {subscription_channel}",
-                        reply_markup=user_subscription_menu()
+                        reply_markup=await user_subscription_menu()
                     )
                 else:
                     await context.bot.send_message(
@@ -801,7 +2634,7 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
             return
             
         target_user_id = int(data.split('_')[1])
-        db.reject_user(target_user_id)
+        await adb.reject_user(target_user_id)
         
         try:
             await context.bot.send_message(
@@ -815,30 +2648,23 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
     
     elif data.startswith('content_'):
         content_id = int(data.split('_')[1])
-        content = db.get_content(content_id)
+        payload = await get_content_payload(content_id)
         
-        if content:
-            if content[3] == 'text':
-                await query.message.reply_text(
-                    f"📖 {content[1]}\n\n{content[2]}\n\n---\nنهاية المحتوى 📚"
-                )
-            elif content[3] == 'photo' and content[5]:
-                await query.message.reply_photo(
-                    photo=content[5],
-                    caption=f"📸 {content[1]}\n\n{content[2]}"
-                )
-            elif content[3] == 'video' and content[5]:
-                await query.message.reply_video(
-                    video=content[5],
-                    caption=f"🎥 {content[1]}\n\n{content[2]}"
-                )
+        if payload:
+            await adb.record_content_view(content_id)
+            if payload.content_type == 'text':
+                await query.message.reply_text(payload.text)
+            elif payload.content_type == 'photo' and payload.file_id:
+                await query.message.reply_photo(photo=payload.file_id, caption=payload.text)
+            elif payload.content_type == 'video' and payload.file_id:
+                await query.message.reply_video(video=payload.file_id, caption=payload.text)
         else:
             await query.message.reply_text("❌ المحتوى غير موجود")
     
     elif data == 'back_to_categories':
-        categories = db.get_categories()
+        categories = await adb.get_categories()
         if categories:
-            await query.message.edit_text("📁 الاقسام المتاحة:\n\nاختر قسم:", reply_markup=user_categories_menu())
+            await query.message.edit_text("📁 الاقسام المتاحة:\n\nاختر قسم:", reply_markup=await user_categories_menu())
         else:
             await query.message.edit_text("⚠️ لا توجد أقسام متاحة حالياً.")
     
@@ -846,17 +2672,18 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
         await query.message.edit_text("🏠 الرئيسية", reply_markup=user_main_menu())
     
     elif data == 'check_subscription' or data == 'refresh_subscription':
-        subscription_required = db.get_setting('subscription_required') == '1'
+        subscription_required = await adb.get_setting('subscription_required') == '1'
         
         if not subscription_required:
             await query.edit_message_text("✅ نظام الاشتراك غير مفعل حالياً")
             return
         
-        is_subscribed = await check_subscription(user_id, context)
+        # زر التحديث يتجاوز النتيجة السلبية المحفوظة لأن المستخدم غالباً اشترك للتو
+        is_subscribed = await check_subscription(user_id, context, force=data == 'refresh_subscription')
         
         if is_subscribed:
-            db.mark_user_subscribed(user_id)
-            success_message = db.get_setting('subscription_success_message')
+            await adb.mark_user_subscribed(user_id)
+            success_message = await adb.get_setting('subscription_success_message')
             
             # إرسال رسالة جديدة بدلاً من تعديل الرسالة القديمة
             await query.message.reply_text(
@@ -870,13 +2697,13 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
             except:
                 pass
         else:
-            subscription_message = db.get_setting('subscription_message')
-            subscription_channel = db.get_setting('subscription_channel')
+            subscription_message = await adb.get_setting('subscription_message')
+            subscription_channel = await adb.get_setting('subscription_channel')
             
             # إرسال رسالة جديدة بدلاً من تعديل الرسالة القديمة
             await query.message.reply_text(
                 f"❌ لم يتم التحقق من اشتراكك بعد!\n\n{subscription_message}\n\nالقناة: {subscription_channel}",
-                reply_markup=user_subscription_menu()
+                reply_markup=await user_subscription_menu()
             )
             
             # حذف الرسالة القديمة
@@ -891,12 +2718,12 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
             return
             
         category_id = int(data.split('_')[2])
-        category = db.get_category_by_id(category_id)
+        category = await adb.get_category_by_id(category_id)
         
         if category:
-            success = db.delete_category(category_id)
+            success = await adb.delete_category(category_id)
             if success:
-                await query.edit_message_text(f"✅ تم حذف القسم: {category[1]}", reply_markup=admin_categories_menu())
+                await query.edit_message_text(f"✅ تم حذف القسم: {category.name}", reply_markup=admin_categories_menu())
             else:
                 await query.edit_message_text("❌ حدث خطأ أثناء حذف القسم")
         else:
@@ -908,17 +2735,106 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
             return
             
         content_id = int(data.split('_')[2])
-        content = db.get_content(content_id)
+        content = await adb.get_content(content_id)
         
         if content:
-            success = db.delete_content(content_id)
+            success = await adb.delete_content(content_id)
             if success:
-                await query.edit_message_text(f"✅ تم حذف المحتوى: {content[1]}", reply_markup=admin_content_menu())
+                await query.edit_message_text(f"✅ تم حذف المحتوى: {content.title}", reply_markup=admin_content_menu())
             else:
                 await query.edit_message_text("❌ حدث خطأ أثناء حذف المحتوى")
         else:
             await query.edit_message_text("❌ المحتوى غير موجود")
     
+    elif data.startswith('cpage_'):
+        _, category_id, direction, content_id, created_date = data.split('_', 4)
+        direction, cursor = parse_page_cursor(direction, content_id, created_date)
+        category = await adb.get_category_by_id(int(category_id))
+        content_menu = await user_content_menu(category.name if category else "", int(category_id), cursor, direction)
+        if content_menu:
+            await query.edit_message_reply_markup(reply_markup=content_menu)
+        else:
+            await query.edit_message_text("⚠️ لا يوجد محتوى في هذه الصفحة.")
+    
+    elif data.startswith('spage_'):
+        search_text = context.user_data.get('search_query')
+        search_results = await user_search_results(search_text, int(data.split('_')[1])) if search_text else None
+        if search_results:
+            results_text, results_menu = search_results
+            await query.edit_message_text(results_text, reply_markup=results_menu)
+        else:
+            await query.edit_message_text("⚠️ انتهت نتائج البحث، أرسل بحثاً جديداً من زر 🔎 بحث.")
+    
+    elif data.startswith('apage_'):
+        if not is_admin(user_id):
+            await query.edit_message_text("❌ ليس لديك صلاحية.")
+            return
+        
+        _, direction, content_id, created_date = data.split('_', 3)
+        direction, cursor = parse_page_cursor(direction, content_id, created_date)
+        content_list = await admin_content_list(cursor, direction)
+        if content_list:
+            await query.edit_message_reply_markup(reply_markup=content_list)
+        else:
+            await query.edit_message_text("⚠️ لا يوجد محتوى في هذه الصفحة.")
+    
+    elif data.startswith('reqpage_'):
+        if not is_admin(user_id):
+            await query.edit_message_text("❌ ليس لديك صلاحية.")
+            return
+
+        requests_page = await join_requests_page(int(data.split('_')[1]))
+        if requests_page:
+            req_text, req_menu, context.user_data['request_page'] = requests_page
+            await query.edit_message_text(req_text, reply_markup=req_menu)
+        else:
+            await query.edit_message_text("✅ لا توجد طلبات انتظار.")
+
+    elif data.startswith('bulk_'):
+        if not is_admin(user_id):
+            await query.edit_message_text("❌ ليس لديك صلاحية.")
+            return
+
+        _, scope, action = data.split('_')
+        label, request_filter = bulk_request_filter(scope, context)
+        count = await adb.count_requests(**request_filter)
+        if not count:
+            await query.edit_message_text("⚠️ لا توجد طلبات مطابقة.")
+            return
+        verb = "قبول" if action == 'approve' else "رفض"
+        keyboard = [
+            [InlineKeyboardButton(f"✅ نعم، {verb} {count}", callback_data=f"bulkok_{scope}_{action}"),
+             InlineKeyboardButton("❌ إلغاء", callback_data="reqpage_0")]
+        ]
+        await query.edit_message_text(
+            f"⚠️ هل تريد {verb} {label} ({count} طلب)؟",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    elif data.startswith('bulkok_'):
+        if not is_admin(user_id):
+            await query.edit_message_text("❌ ليس لديك صلاحية.")
+            return
+
+        _, scope, action = data.split('_')
+        label, request_filter = bulk_request_filter(scope, context)
+        approve = action == 'approve'
+        notification = "🎉 تمت الموافقة على طلبك!" if approve else "❌ تم رفض طلب انضمامك."
+        broadcast_id, count = await adb.moderate_requests(
+            approve, notification, query.message.chat_id, **request_filter
+        )
+        if not broadcast_id:
+            await query.edit_message_text("⚠️ لا توجد طلبات مطابقة.")
+            return
+        if scope == 'page':
+            context.user_data.pop('request_page', None)
+        # الإشعارات تمر بمحرك البث بنفس حد الإرسال، وتُستأنف بعد إعادة التشغيل
+        broadcast_engine.start(context.bot, broadcast_id)
+        result = "✅ تمت الموافقة على" if approve else "❌ تم رفض"
+        await query.edit_message_text(
+            f"{result} {count} طلب ({label})\n\n📨 جاري إرسال الإشعارات في الخلفية، وسيصلك تقرير بالتقدم."
+        )
+
     elif data == 'cancel_delete':
         await query.edit_message_text("❌ تم إلغاء العملية", reply_markup=admin_main_menu())
     
@@ -936,6 +2852,7 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
         
         await show_backup_history(update, context)
 
+@timed_handler
 async def handle_media(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
     user_id = user.id
@@ -952,7 +2869,7 @@ async def handle_media(update: Update, context: CallbackContext) -> None:
             await restore_backup_from_file(update, context, file)
             return
     
-    if context.user_data.get('content_stage') == 'content':
+    if context.user_data.get('state') == 'content_body':
         content_type = None
         file_id = None
         
@@ -966,52 +2883,41 @@ async def handle_media(update: Update, context: CallbackContext) -> None:
         if content_type and file_id:
             context.user_data['content_file_id'] = file_id
             context.user_data['content_type'] = content_type
-            context.user_data['content_stage'] = 'category'
-            
-            categories = db.get_categories()
-            if categories:
-                keyboard = []
-                for cat in categories:
-                    keyboard.append([KeyboardButton(cat[1])])
-                keyboard.append([KeyboardButton("🔙 إدارة المحتوى")])
-                
-                await update.message.reply_text(
-                    "📁 المرحلة 3 من 3\n\nاختر القسم الذي تريد إضافة المحتوى إليه:",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                )
-            else:
-                await update.message.reply_text("⚠️ لا توجد أقسام. أضف قسم أولاً.")
-                context.user_data.clear()
+            await ask_content_category(update, context)
+
+async def handle_text_message(update: Update, context: CallbackContext) -> None:
+    # التوجيه قبل القياس حتى يكون لرسائل المدير والمستخدمين مدرج منفصل
+    if is_admin(update.message.from_user.id):
+        await handle_admin_message(update, context)
+    else:
+        await handle_user_message(update, context)
 
+@timed_handler
 async def handle_user_message(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
     text = update.message.text
     user_id = user.id
     
-    if is_admin(user_id):
-        await handle_admin_message(update, context)
-        return
-    
-    db.update_user_activity(user_id)
-    user_data = db.get_user(user_id)
+    await adb.update_user_activity(user_id)
+    user_data = await adb.get_user(user_id)
     
     if not user_data:
         # إذا لم يكن المستخدم موجوداً في النظام
-        await start(update, context)
+        await welcome_user(update, context)
         return
     
-    if user_data[4] == 0:  # المستخدم غير مقبول
+    if user_data.is_approved == 0:  # المستخدم غير مقبول
         if text == "🔄 تحديث الحالة":
-            user_data = db.get_user(user_id)
-            if user_data and user_data[4] == 1:
-                subscription_required = db.get_setting('subscription_required') == '1'
-                if subscription_required and user_data[9] == 0:
-                    subscription_message = db.get_setting('subscription_message')
-                    subscription_channel = db.get_setting('subscription_channel')
+            user_data = await adb.get_user(user_id)
+            if user_data and user_data.is_approved == 1:
+                subscription_required = await adb.get_setting('subscription_required') == '1'
+                if subscription_required and user_data.has_subscribed == 0:
+                    subscription_message = await adb.get_setting('subscription_message')
+                    subscription_channel = await adb.get_setting('subscription_channel')
                     
                     await update.message.reply_text(
                         f"🎉 تمت الموافقة على طلبك!\n\n{subscription_message}\n\nالقناة: {subscription_channel}",
-                        reply_markup=user_subscription_menu()
+                        reply_markup=await user_subscription_menu()
                     )
                     return
                 
@@ -1021,54 +2927,69 @@ async def handle_user_message(update: Update, context: CallbackContext) -> None:
         return
     
     # التحقق من الاشتراك إذا كان مطلوباً
-    subscription_required = db.get_setting('subscription_required') == '1'
-    if subscription_required and user_data[9] == 0:
+    subscription_required = await adb.get_setting('subscription_required') == '1'
+    if subscription_required and user_data.has_subscribed == 0:
         if text != "🔄 تحديث الحالة":
-            subscription_message = db.get_setting('subscription_message')
-            subscription_channel = db.get_setting('subscription_channel')
+            subscription_message = await adb.get_setting('subscription_message')
+            subscription_channel = await adb.get_setting('subscription_channel')
             
             await update.message.reply_text(
                 f"{subscription_message}\n\nالقناة: {subscription_channel}",
-                reply_markup=user_subscription_menu()
+                reply_markup=await user_subscription_menu()
             )
             return
     
+    searching = context.user_data.pop('state', None) == 'searching'
+
     if text == "🏠 الرئيسية":
         await update.message.reply_text("🏠 الرئيسية", reply_markup=user_main_menu())
     
     elif text == "📁 الاقسام":
-        categories = db.get_categories()
+        categories = await adb.get_categories()
         if categories:
-            await update.message.reply_text("📁 الاقسام المتاحة:\n\nاختر قسم:", reply_markup=user_categories_menu())
+            await update.message.reply_text("📁 الاقسام المتاحة:\n\nاختر قسم:", reply_markup=await user_categories_menu())
         else:
             await update.message.reply_text("⚠️ لا توجد أقسام متاحة حالياً.")
     
     elif text == "📚 آخر القصص":
-        recent_content = db.get_recent_content(7)
-        if recent_content:
+        recent_menu = await user_recent_content_menu()
+        if recent_menu:
             await update.message.reply_text(
                 "📚 آخر القصص المضافة:\n\nاختر قصة للقراءة:",
-                reply_markup=user_recent_content_menu()
+                reply_markup=recent_menu
             )
         else:
             await update.message.reply_text("⚠️ لا توجد قصص متاحة حالياً.")
     
+    elif text == "🔎 بحث":
+        context.user_data['state'] = 'searching'
+        await update.message.reply_text("🔎 أرسل كلمة أو أكثر للبحث في العناوين والمحتوى:")
+    
     elif text == "ℹ️ حول البوت":
-        about_text = db.get_setting('about_text')
+        about_text = await adb.get_setting('about_text')
         await update.message.reply_text(about_text)
     
     elif text == "📞 اتصل بنا":
-        contact_text = db.get_setting('contact_text')
+        contact_text = await adb.get_setting('contact_text')
         await update.message.reply_text(contact_text)
     
+    elif searching:
+        context.user_data['search_query'] = text
+        search_results = await user_search_results(text)
+        if search_results:
+            results_text, results_menu = search_results
+            await update.message.reply_text(results_text, reply_markup=results_menu)
+        else:
+            await update.message.reply_text(f"⚠️ لا توجد نتائج للبحث عن: {text}", reply_markup=user_main_menu())
+    
     else:
-        category_id = get_category_id_by_name(text)
+        category_id = await get_category_id_by_name(text)
         if category_id:
-            content_items = db.get_content_by_category(category_id)
-            if content_items:
+            content_menu = await user_content_menu(text, category_id)
+            if content_menu:
                 await update.message.reply_text(
                     f"📁 قسم: {text}\n\nاختر المحتوى:",
-                    reply_markup=user_content_menu(text, category_id)
+                    reply_markup=content_menu
                 )
             else:
                 await update.message.reply_text(f"⚠️ لا يوجد محتوى في قسم {text}.")
@@ -1078,6 +2999,135 @@ async def handle_user_message(update: Update, context: CallbackContext) -> None:
 
 # ... باقي دوال handle_admin_message و error_handler تبقى كما هي بدون تغيير ...
 # [يتبع باقي الكود بدون تغيير]
+# مراحل المدير: كل رسالة نصية لا تطابق زراً تُوجه حسب context.user_data['state']
+# إلى دالة واحدة من ADMIN_STATE_HANDLERS. باقي بيانات المرحلة تُحفظ في مفاتيح أخرى.
+
+async def ask_content_category(update: Update, context: CallbackContext):
+    categories = await adb.get_categories()
+    if categories:
+        context.user_data['state'] = 'content_category'
+        await update.message.reply_text(
+            "📁 المرحلة 3 من 3\n\nاختر القسم الذي تريد إضافة المحتوى إليه:",
+            reply_markup=await admin_category_picker()
+        )
+    else:
+        await update.message.reply_text("⚠️ لا توجد أقسام. أضف قسم أولاً.")
+        context.user_data.clear()
+
+async def admin_content_type_step(update: Update, context: CallbackContext, text):
+    content_type_map = {"📝 نص": "text", "📸 صورة": "photo", "🎥 فيديو": "video"}
+    if text in content_type_map:
+        context.user_data['content_type'] = content_type_map[text]
+        context.user_data['state'] = 'content_title'
+        
+        await update.message.reply_text("✏️ المرحلة 1 من 3\n\nأرسل عنوان المحتوى (مثال: قصة جميلة، فيديو رائع، إلخ):")
+
+async def admin_content_title_step(update: Update, context: CallbackContext, text):
+    context.user_data['content_title'] = text
+    context.user_data['state'] = 'content_body'
+    
+    content_type = context.user_data.get('content_type')
+    if content_type == 'text':
+        await update.message.reply_text("📝 المرحلة 2 من 3\n\nأرسل محتوى النص:")
+    else:
+        type_name = "صورة" if content_type == 'photo' else "فيديو"
+        await update.message.reply_text(f"📸 المرحلة 2 من 3\n\nأرسل {type_name} الآن:")
+
+async def admin_content_body_step(update: Update, context: CallbackContext, text):
+    # الصور والفيديو تصل إلى handle_media، والنص فقط يصل إلى هنا
+    if context.user_data.get('content_type') == 'text':
+        context.user_data['content_description'] = text
+        await ask_content_category(update, context)
+
+async def admin_content_category_step(update: Update, context: CallbackContext, text):
+    category_name = text
+    category_id = await get_category_id_by_name(category_name)
+    if category_id:
+        title = context.user_data.get('content_title', 'بدون عنوان')
+        content_type = context.user_data.get('content_type', 'text')
+        description = context.user_data.get('content_description', '')
+        file_id = context.user_data.get('content_file_id')
+        
+        content_id = await adb.add_content(title, description, content_type, category_id, file_id)
+        
+        content_type_name = "نص" if content_type == 'text' else "صورة" if content_type == 'photo' else "فيديو"
+        
+        await update.message.reply_text(
+            f"✅ تم إضافة المحتوى بنجاح!\n\n"
+            f"📝 النوع: {content_type_name}\n"
+            f"🎯 العنوان: {title}\n"
+            f"📁 القسم: {category_name}\n"
+            f"🆔 الرقم: {content_id}",
+            reply_markup=admin_content_menu()
+        )
+        context.user_data.clear()
+    else:
+        await update.message.reply_text("❌ قسم غير موجود. الرجاء اختيار قسم من القائمة.")
+
+async def admin_delete_user_step(update: Update, context: CallbackContext, text):
+    try:
+        target_user_id = int(text)
+        await adb.delete_user(target_user_id)
+        await update.message.reply_text(f"✅ تم حذف المستخدم {target_user_id}", reply_markup=admin_users_menu())
+    except:
+        await update.message.reply_text("❌ ID غير صحيح", reply_markup=admin_users_menu())
+    context.user_data.clear()
+
+async def admin_add_category_step(update: Update, context: CallbackContext, text):
+    category_id = await adb.add_category(text)
+    await update.message.reply_text(f"✅ تم إضافة القسم: {text} (ID: {category_id})", reply_markup=admin_categories_menu())
+    context.user_data.clear()
+
+async def admin_rename_category_step(update: Update, context: CallbackContext, text):
+    category_id = context.user_data.get('editing_category_id')
+    old_name = context.user_data.get('editing_category_name')
+    if category_id:
+        await adb.update_category(category_id, text)
+        await update.message.reply_text(f"✅ تم تعديل القسم من '{old_name}' إلى '{text}'", reply_markup=admin_categories_menu())
+    context.user_data.clear()
+
+async def admin_broadcast_step(update: Update, context: CallbackContext, text):
+    broadcast_id = await adb.create_broadcast(text, update.effective_chat.id)
+    broadcast_engine.start(context.bot, broadcast_id)
+    await update.message.reply_text(
+        "📢 بدأ البث في الخلفية، وسيصلك تقرير بالنتيجة عند الانتهاء",
+        reply_markup=admin_main_menu()
+    )
+    context.user_data.clear()
+
+async def admin_setting_step(setting_key, message, menu, update: Update, context: CallbackContext, text):
+    await adb.update_setting(setting_key, text)
+    markup = menu()
+    if asyncio.iscoroutine(markup):
+        markup = await markup
+    await update.message.reply_text(message.format(value=text), reply_markup=markup)
+    context.user_data.clear()
+
+# حالة التعديل ← (مفتاح الإعداد، رسالة النجاح، القائمة المعروضة بعد الحفظ)
+SETTING_STATES = {
+    'editing_subscription_message': ('subscription_message', "✅ تم تحديث رسالة الاشتراك", admin_subscription_menu),
+    'editing_subscription_channel': ('subscription_channel', "✅ تم تحديث رابط القناة إلى: {value}", admin_subscription_menu),
+    'editing_subscription_success': ('subscription_success_message', "✅ تم تحديث رسالة النجاح", admin_subscription_menu),
+    'editing_backup_password': ('backup_password', "✅ تم تحديث كلمة سر النسخ الاحتياطي إلى: {value}", admin_backup_menu),
+    'editing_welcome': ('welcome_message', "✅ تم تحديث رسالة الترحيب", admin_settings_menu),
+    'editing_about': ('about_text', "✅ تم تحديث حول البوت", admin_settings_menu),
+    'editing_contact': ('contact_text', "✅ تم تحديث اتصل بنا", admin_settings_menu),
+    'editing_start_button': ('start_button_text', "✅ تم تحديث زر البدء", admin_settings_menu),
+}
+
+ADMIN_STATE_HANDLERS = {
+    'content_type': admin_content_type_step,
+    'content_title': admin_content_title_step,
+    'content_body': admin_content_body_step,
+    'content_category': admin_content_category_step,
+    'awaiting_user_delete': admin_delete_user_step,
+    'adding_category': admin_add_category_step,
+    'renaming_category': admin_rename_category_step,
+    'broadcasting': admin_broadcast_step,
+    **{state: functools.partial(admin_setting_step, *spec) for state, spec in SETTING_STATES.items()},
+}
+
+@timed_handler
 async def handle_admin_message(update: Update, context: CallbackContext) -> None:
     user = update.message.from_user
     text = update.message.text
@@ -1086,7 +3136,7 @@ async def handle_admin_message(update: Update, context: CallbackContext) -> None
     if not is_admin(user_id):
         return
 
-    db.update_user_activity(user_id)
+    await adb.update_user_activity(user_id)
 
     if text in ["🔙 لوحة التحكم", "🔙 إدارة الأقسام", "🔙 إدارة المحتوى", "🔙 إدارة المستخدمين", "🔙 النسخ الاحتياطي", "🔙 الإعدادات"]:
         context.user_data.clear()
@@ -1113,33 +3163,33 @@ async def handle_admin_message(update: Update, context: CallbackContext) -> None
         return
     
     elif text == "📢 إعدادات الاشتراك":
-        await update.message.reply_text("📢 إعدادات الاشتراك الإجباري", reply_markup=admin_subscription_menu())
+        await update.message.reply_text("📢 إعدادات الاشتراك الإجباري", reply_markup=await admin_subscription_menu())
         return
     
     elif text.startswith("🔧 حالة الاشتراك:"):
-        current = db.get_setting('subscription_required')
+        current = await adb.get_setting('subscription_required')
         new_status = '0' if current == '1' else '1'
-        db.update_setting('subscription_required', new_status)
+        await adb.update_setting('subscription_required', new_status)
         status = "معطل" if new_status == '0' else "مفعل"
-        await update.message.reply_text(f"✅ تم {status} نظام الاشتراك الإجباري", reply_markup=admin_subscription_menu())
+        await update.message.reply_text(f"✅ تم {status} نظام الاشتراك الإجباري", reply_markup=await admin_subscription_menu())
         return
     
     elif text == "✏️ رسالة الاشتراك":
-        current = db.get_setting('subscription_message')
+        current = await adb.get_setting('subscription_message')
         await update.message.reply_text(f"الرسالة الحالية:\n{current}\n\nأرسل الرسالة الجديدة:")
-        context.user_data['editing_subscription_message'] = True
+        context.user_data['state'] = 'editing_subscription_message'
         return
     
     elif text == "🔗 رابط القناة":
-        current = db.get_setting('subscription_channel')
+        current = await adb.get_setting('subscription_channel')
         await update.message.reply_text(f"رابط القناة الحالي: {current}\n\nأرسل رابط القناة الجديد (مثال: @channel_name):")
-        context.user_data['editing_subscription_channel'] = True
+        context.user_data['state'] = 'editing_subscription_channel'
         return
     
     elif text == "✏️ رسالة النجاح":
-        current = db.get_setting('subscription_success_message')
+        current = await adb.get_setting('subscription_success_message')
         await update.message.reply_text(f"الرسالة الحالية:\n{current}\n\nأرسل الرسالة الجديدة:")
-        context.user_data['editing_subscription_success'] = True
+        context.user_data['state'] = 'editing_subscription_success'
         return
     
     elif text == "💾 النسخ الاحتياطي":
@@ -1150,9 +3200,13 @@ async def handle_admin_message(update: Update, context: CallbackContext) -> None
         await show_statistics(update, context)
         return
     
+    elif text == "📈 الأداء":
+        await show_performance(update, context)
+        return
+    
     elif text == "📢 البث الجماعي":
         await update.message.reply_text("أرسل الرسالة للبث لجميع المستخدمين:")
-        context.user_data['broadcasting'] = True
+        context.user_data['state'] = 'broadcasting'
         return
     
     elif text == "📥 تنزيل نسخة":
@@ -1160,14 +3214,20 @@ async def handle_admin_message(update: Update, context: CallbackContext) -> None
         await create_and_send_backup(update, context)
         return
     
+    elif text == "🧩 نسخة تفاضلية":
+        await update.message.reply_text("🔄 جاري إنشاء النسخة التفاضلية...")
+        await create_and_send_backup(update, context, incremental=True)
+        return
+    
     elif text == "📤 رفع نسخة":
         await update.message.reply_text(
             "📤 لرفع نسخة احتياطية:\n\n"
             "1. أرسل ملف النسخة الاحتياطية (بصيغة .Mkfrky)\n"
-            "2. انتظر اكتمال الاستعادة\n\n"
+            "2. انتظر اكتمال الاستعادة\n"
+            "3. للنسخ التفاضلية: أرسل النسخة الكاملة أولاً ثم النسخ التفاضلية بالترتيب\n\n"
             "⚠️ تحذير: سيتم استبدال جميع البيانات الحالية!"
         )
-        context.user_data['awaiting_backup_file'] = True
+        context.user_data['state'] = 'awaiting_backup_file'
         return
     
     elif text == "📋 سجل النسخ":
@@ -1175,54 +3235,52 @@ async def handle_admin_message(update: Update, context: CallbackContext) -> None
         return
     
     elif text == "🔧 إعدادات النسخ":
-        current_password = db.get_setting('backup_password')
+        current_password = await adb.get_setting('backup_password')
         await update.message.reply_text(
             f"🔧 إعدادات النسخ الاحتياطي:\n\n"
             f"🔐 كلمة السر الحالية: {current_password}\n\n"
             f"أرسل كلمة السر الجديدة:"
         )
-        context.user_data['editing_backup_password'] = True
+        context.user_data['state'] = 'editing_backup_password'
         return
     
     elif text == "📋 عرض المستخدمين":
-        users = db.get_all_users()
+        users = await adb.get_all_users()
         if users:
             users_text = "👥 المستخدمون:\n\n"
             for user_data in users:
-                subscription_status = "✅" if user_data[9] == 1 else "❌"
-                users_text += f"{subscription_status} {user_data[0]} - 👤 {user_data[2]}\n"
+                subscription_status = "✅" if user_data.has_subscribed == 1 else "❌"
+                users_text += f"{subscription_status} {user_data.user_id} - 👤 {user_data.first_name}\n"
             await update.message.reply_text(users_text)
         else:
             await update.message.reply_text("⚠️ لا يوجد مستخدمين.")
         return
     
     elif text == "⏳ طلبات الانضمام":
-        requests = db.get_pending_requests()
-        if requests:
-            req_text = "📩 طلبات الانضمام:\n\n"
-            for req in requests:
-                req_text += f"🆔 {req[0]} - 👤 {req[2]} - 📱 @{req[1] or 'لا يوجد'}\n"
-            await update.message.reply_text(req_text)
+        requests_page = await join_requests_page()
+        if requests_page:
+            req_text, req_menu, context.user_data['request_page'] = requests_page
+            await update.message.reply_text(req_text, reply_markup=req_menu)
         else:
             await update.message.reply_text("✅ لا توجد طلبات انتظار.")
         return
     
     elif text == "🗑 حذف مستخدم":
         await update.message.reply_text("أرسل ID المستخدم للحذف:")
-        context.user_data['awaiting_user_delete'] = True
+        context.user_data['state'] = 'awaiting_user_delete'
         return
     
     elif text == "➕ إضافة قسم":
         await update.message.reply_text("أرسل اسم القسم الجديد:")
-        context.user_data['adding_category'] = True
+        context.user_data['state'] = 'adding_category'
         return
     
     elif text == "✏️ تعديل قسم":
-        categories = db.get_categories()
+        categories = await adb.get_categories()
         if categories:
             keyboard = []
             for cat in categories:
-                keyboard.append([KeyboardButton(f"تعديل {cat[1]}")])
+                keyboard.append([KeyboardButton(f"تعديل {cat.name}")])
             keyboard.append([KeyboardButton("🔙 إدارة الأقسام")])
             await update.message.reply_text("اختر قسم للتعديل:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
         else:
@@ -1231,287 +3289,434 @@ async def handle_admin_message(update: Update, context: CallbackContext) -> None
     
     elif text.startswith("تعديل "):
         category_name = text[6:]
-        category_id = get_category_id_by_name(category_name)
+        category_id = await get_category_id_by_name(category_name)
         if category_id:
             context.user_data['editing_category_id'] = category_id
             context.user_data['editing_category_name'] = category_name
+            context.user_data['state'] = 'renaming_category'
             await update.message.reply_text(f"✏️ تعديل القسم: {category_name}\n\nأرسل الاسم الجديد للقسم:")
-            context.user_data['awaiting_new_category_name'] = True
         else:
             await update.message.reply_text("❌ قسم غير موجود")
         return
     
     elif text == "📋 عرض الأقسام":
-        categories = db.get_categories()
+        categories = await adb.get_categories()
         if categories:
             cats_text = "📁 جميع الأقسام:\n\n"
             for cat in categories:
-                cats_text += f"📁 {cat[1]} (ID: {cat[0]})\n"
+                cats_text += f"📁 {cat.name} (ID: {cat.id})\n"
             await update.message.reply_text(cats_text)
         else:
             await update.message.reply_text("⚠️ لا توجد أقسام.")
         return
     
     elif text == "🗑 حذف قسم":
-        categories = db.get_categories()
+        categories = await adb.get_categories()
         if categories:
             await update.message.reply_text(
                 "اختر قسم للحذف:",
-                reply_markup=admin_categories_list()
+                reply_markup=await admin_categories_list()
             )
         else:
             await update.message.reply_text("⚠️ لا توجد أقسام.")
         return
     
     elif text == "➕ إضافة محتوى":
-        categories = db.get_categories()
+        categories = await adb.get_categories()
         if not categories:
             await update.message.reply_text("⚠️ لا توجد أقسام. أضف قسم أولاً.")
             return
         
-        context.user_data['adding_content'] = True
-        context.user_data['content_stage'] = 'type'
+        context.user_data['state'] = 'content_type'
         
-        keyboard = [
-            [KeyboardButton("📝 نص"), KeyboardButton("📸 صورة")],
-            [KeyboardButton("🎥 فيديو"), KeyboardButton("🔙 إدارة المحتوى")]
-        ]
-        await update.message.reply_text("📝 بدء إضافة محتوى جديد\n\nاختر نوع المحتوى:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+        await update.message.reply_text("📝 بدء إضافة محتوى جديد\n\nاختر نوع المحتوى:", reply_markup=admin_content_type_menu())
         return
     
     elif text == "📋 عرض المحتوى":
-        content_items = db.get_all_content()
+        content_items = await adb.get_all_content()
         if content_items:
             content_text = "📦 جميع المحتويات:\n\n"
             for content in content_items:
-                content_type_icon = "📝" if content[3] == 'text' else "📸" if content[3] == 'photo' else "🎥"
-                content_text += f"{content_type_icon} {content[1]} - {get_category_name_by_id(content[4])}\n"
+                content_type_icon = "📝" if content.content_type == 'text' else "📸" if content.content_type == 'photo' else "🎥"
+                content_text += f"{content_type_icon} {content.title} - {content.category_name}\n"
             await update.message.reply_text(content_text)
         else:
             await update.message.reply_text("⚠️ لا يوجد محتوى.")
         return
     
     elif text == "🗑 حذف محتوى":
-        content_items = db.get_all_content()
-        if content_items:
+        content_list = await admin_content_list()
+        if content_list:
             await update.message.reply_text(
                 "اختر محتوى للحذف:",
-                reply_markup=admin_content_list()
+                reply_markup=content_list
             )
         else:
             await update.message.reply_text("⚠️ لا يوجد محتوى.")
         return
     
     elif text == "✏️ رسالة الترحيب":
-        current = db.get_setting('welcome_message')
+        current = await adb.get_setting('welcome_message')
         await update.message.reply_text(f"الرسالة الحالية:\n{current}\n\nأرسل الرسالة الجديدة:")
-        context.user_data['editing_welcome'] = True
+        context.user_data['state'] = 'editing_welcome'
         return
     
     elif text == "📝 حول البوت":
-        current = db.get_setting('about_text')
+        current = await adb.get_setting('about_text')
         await update.message.reply_text(f"النص الحالي:\n{current}\n\nأرسل النص الجديد:")
-        context.user_data['editing_about'] = True
+        context.user_data['state'] = 'editing_about'
         return
     
     elif text == "📞 اتصل بنا":
-        current = db.get_setting('contact_text')
+        current = await adb.get_setting('contact_text')
         await update.message.reply_text(f"النص الحالي:\n{current}\n\nأرسل النص الجديد:")
-        context.user_data['editing_contact'] = True
+        context.user_data['state'] = 'editing_contact'
         return
     
     elif text == "🔄 زر البدء":
-        current = db.get_setting('start_button_text')
+        current = await adb.get_setting('start_button_text')
         await update.message.reply_text(f"النص الحالي: {current}\n\nأرسل النص الجديد لزر البدء:")
-        context.user_data['editing_start_button'] = True
+        context.user_data['state'] = 'editing_start_button'
         return
     
     elif text == "🔐 نظام الموافقة":
-        current = db.get_setting('approval_required')
+        current = await adb.get_setting('approval_required')
         new_status = '0' if current == '1' else '1'
-        db.update_setting('approval_required', new_status)
+        await adb.update_setting('approval_required', new_status)
         status = "❌ معطل" if new_status == '0' else "✅ مفعل"
         await update.message.reply_text(f"{status} نظام الموافقة")
         return
     
-    elif context.user_data.get('content_stage') == 'type':
-        if text in ["📝 نص", "📸 صورة", "🎥 فيديو"]:
-            content_type_map = {"📝 نص": "text", "📸 صورة": "photo", "🎥 فيديو": "video"}
-            context.user_data['content_type'] = content_type_map[text]
-            context.user_data['content_stage'] = 'title'
-            
-            await update.message.reply_text("✏️ المرحلة 1 من 3\n\nأرسل عنوان المحتوى (مثال: قصة جميلة، فيديو رائع، إلخ):")
-            return
-    
-    elif context.user_data.get('content_stage') == 'title':
-        context.user_data['content_title'] = text
-        context.user_data['content_stage'] = 'content'
-        
-        content_type = context.user_data.get('content_type')
-        if content_type == 'text':
-            await update.message.reply_text("📝 المرحلة 2 من 3\n\nأرسل محتوى النص:")
-        else:
-            type_name = "صورة" if content_type == 'photo' else "فيديو"
-            await update.message.reply_text(f"📸 المرحلة 2 من 3\n\nأرسل {type_name} الآن:")
-        return
-    
-    elif context.user_data.get('content_stage') == 'content':
-        if context.user_data.get('content_type') == 'text':
-            context.user_data['content_description'] = text
-            context.user_data['content_stage'] = 'category'
-            
-            categories = db.get_categories()
-            if categories:
-                keyboard = []
-                for cat in categories:
-                    keyboard.append([KeyboardButton(cat[1])])
-                keyboard.append([KeyboardButton("🔙 إدارة المحتوى")])
-                
-                await update.message.reply_text(
-                    "📁 المرحلة 3 من 3\n\nاختر القسم الذي تريد إضافة المحتوى إليه:",
-                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                )
-            else:
-                await update.message.reply_text("⚠️ لا توجد أقسام. أضف قسم أولاً.")
-                context.user_data.clear()
-        return
-    
-    elif context.user_data.get('content_stage') == 'category':
-        category_name = text
-        category_id = get_category_id_by_name(category_name)
-        if category_id:
-            title = context.user_data.get('content_title', 'بدون عنوان')
-            content_type = context.user_data.get('content_type', 'text')
-            description = context.user_data.get('content_description', '')
-            file_id = context.user_data.get('content_file_id')
-            
-            content_id = db.add_content(title, description, content_type, category_id, file_id)
-            
-            content_type_name = "نص" if content_type == 'text' else "صورة" if content_type == 'photo' else "فيديو"
-            
-            await update.message.reply_text(
-                f"✅ تم إضافة المحتوى بنجاح!\n\n"
-                f"📝 النوع: {content_type_name}\n"
-                f"🎯 العنوان: {title}\n"
-                f"📁 القسم: {category_name}\n"
-                f"🆔 الرقم: {content_id}",
-                reply_markup=admin_content_menu()
-            )
-            context.user_data.clear()
-        else:
-            await update.message.reply_text("❌ قسم غير موجود. الرجاء اختيار قسم من القائمة.")
-        return
-    
-    elif context.user_data.get('awaiting_user_delete'):
-        try:
-            target_user_id = int(text)
-            db.delete_user(target_user_id)
-            await update.message.reply_text(f"✅ تم حذف المستخدم {target_user_id}", reply_markup=admin_users_menu())
-        except:
-            await update.message.reply_text("❌ ID غير صحيح", reply_markup=admin_users_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('adding_category'):
-        category_id = db.add_category(text)
-        await update.message.reply_text(f"✅ تم إضافة القسم: {text} (ID: {category_id})", reply_markup=admin_categories_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('awaiting_new_category_name'):
-        category_id = context.user_data.get('editing_category_id')
-        old_name = context.user_data.get('editing_category_name')
-        if category_id:
-            db.update_category(category_id, text)
-            await update.message.reply_text(f"✅ تم تعديل القسم من '{old_name}' إلى '{text}'", reply_markup=admin_categories_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('editing_subscription_message'):
-        db.update_setting('subscription_message', text)
-        await update.message.reply_text("✅ تم تحديث رسالة الاشتراك", reply_markup=admin_subscription_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('editing_subscription_channel'):
-        db.update_setting('subscription_channel', text)
-        await update.message.reply_text(f"✅ تم تحديث رابط القناة إلى: {text}", reply_markup=admin_subscription_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('editing_subscription_success'):
-        db.update_setting('subscription_success_message', text)
-        await update.message.reply_text("✅ تم تحديث رسالة النجاح", reply_markup=admin_subscription_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('editing_backup_password'):
-        db.update_setting('backup_password', text)
-        await update.message.reply_text(f"✅ تم تحديث كلمة سر النسخ الاحتياطي إلى: {text}", reply_markup=admin_backup_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('editing_welcome'):
-        db.update_setting('welcome_message', text)
-        await update.message.reply_text("✅ تم تحديث رسالة الترحيب", reply_markup=admin_settings_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('editing_about'):
-        db.update_setting('about_text', text)
-        await update.message.reply_text("✅ تم تحديث حول البوت", reply_markup=admin_settings_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('editing_contact'):
-        db.update_setting('contact_text', text)
-        await update.message.reply_text("✅ تم تحديث اتصل بنا", reply_markup=admin_settings_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('editing_start_button'):
-        db.update_setting('start_button_text', text)
-        await update.message.reply_text("✅ تم تحديث زر البدء", reply_markup=admin_settings_menu())
-        context.user_data.clear()
-        return
-    
-    elif context.user_data.get('broadcasting'):
-        users = db.get_all_users()
-        success = 0
-        for user_data in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_data[0], 
-                    text=f"*إشعار عام من الإدارة:*\n\n{text}"
-                )
-                success += 1
-            except:
-                continue
-        await update.message.reply_text(f"✅ تم الإرسال إلى {success} مستخدم", reply_markup=admin_main_menu())
-        context.user_data.clear()
-        return
-    
     else:
-        await update.message.reply_text("👑 لوحة تحكم المدير", reply_markup=admin_main_menu())
+        state_handler = ADMIN_STATE_HANDLERS.get(context.user_data.get('state'))
+        if state_handler:
+            await state_handler(update, context, text)
+        else:
+            await update.message.reply_text("👑 لوحة تحكم المدير", reply_markup=admin_main_menu())
 
 async def error_handler(update: Update, context: CallbackContext) -> None:
     logger.error(f"حدث خطأ: {context.error}")
 
-def main():
-    token = os.getenv('TELEGRAM_BOT_TOKEN')
-    if not token:
-        raise ValueError("❌ لم يتم تعيين TELEGRAM_BOT_TOKEN")
-    
-    application = Application.builder().token(token).build()
+async def activity_flusher():
+    while True:
+        await asyncio.sleep(1)
+        if db.activity.due():
+            try:
+                await adb.flush_activity()
+            except Exception as e:
+                logger.error(f"خطأ في حفظ نشاط المستخدمين: {e}")
+        if db.views.due():
+            try:
+                await adb.flush_content_views()
+            except Exception as e:
+                logger.error(f"خطأ في حفظ مشاهدات المحتوى: {e}")
+
+async def post_init(application: Application) -> None:
+    start_background_task(activity_flusher())
+    start_background_task(subscription_rechecker(
+        application.bot, interval=int(os.getenv('SUBSCRIPTION_RECHECK_INTERVAL', 21600))
+    ))
+    # استئناف البث الذي توقف بسبب إعادة التشغيل
+    for broadcast in await adb.get_unfinished_broadcasts():
+        broadcast_engine.start(application.bot, broadcast.id)
+    # في وضع webhook يعمل /health و /metrics على خادم الـ webhook نفسه، وفي وضع polling
+    # على METRICS_PORT أو PORT حتى ينجح فحص الصحة في منصات مثل Render
+    status_port = os.getenv('METRICS_PORT') or os.getenv('PORT')
+    if status_port and not os.getenv('WEBHOOK_URL'):
+        tornado.httpserver.HTTPServer(tornado.web.Application([
+            (r'/health', HealthHandler, {'bot_app': application, 'draining': asyncio.Event()}),
+            (r'/metrics', MetricsHandler),
+        ], log_function=log_http_request)).listen(int(status_port))
+
+async def post_stop(application: Application) -> None:
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def post_shutdown(application: Application) -> None:
+    # كتابة النشاط المتبقي وانتظار انتهاء طابور قاعدة البيانات قبل إغلاق الاتصالات
+    await adb.flush_activity()
+    await adb.flush_content_views()
+    adb.close()
+
+class InstrumentedRequest(HTTPXRequest):
+    """طلبات Bot API مع قياس زمن كل طريقة وعدد أخطائها"""
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        except Exception:
+            metrics.inc('bot_telegram_errors_total', endpoint)
+            raise
+        finally:
+            metrics.observe('bot_telegram_seconds', endpoint, time.perf_counter() - started)
+        if code >= 400:
+            metrics.inc('bot_telegram_errors_total', endpoint)
+        return code, payload
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
+
+class SQLitePersistence(BasePersistence):
+    """حفظ user_data و chat_data في قاعدة بيانات البوت"""
+    # التعديلات تُجمع في الذاكرة وتُكتب في معاملة واحدة كل update_interval
+
+    def __init__(self, database, update_interval=60):
+        super().__init__(store_data=PersistenceInput(bot_data=False, callback_data=False), update_interval=update_interval)
+        self.database = database
+        self._pending = {}
+        self._write_task = None
+
+    async def get_user_data(self):
+        return await self.database.load_persistent_data('user')
+
+    async def get_chat_data(self):
+        return await self.database.load_persistent_data('chat')
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_user_data(self, user_id, data):
+        self._stage('user', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage('chat', chat_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._stage('user', user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._stage('chat', chat_id, None)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self._write_task:
+            await self._write_task
+        await self._write()
+
+    def _stage(self, kind, key, data):
+        # تحويل البيانات إلى JSON فوراً لأن القاموس قد يتغير قبل الكتابة، والقاموس الفارغ يُحذف
+        self._pending[(kind, key)] = json.dumps(data, ensure_ascii=False) if data else None
+        if not self._write_task:
+            # تُنفذ بعد انتهاء باقي استدعاءات نفس الدورة فتُكتب كلها دفعة واحدة
+            self._write_task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        self._write_task = None
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            await self.database.save_persistent_data([(kind, key, data) for (kind, key), data in pending.items()])
+        except Exception as e:
+            logger.error(f"خطأ في حفظ بيانات المحادثات: {e}")
+            for entry, data in pending.items():
+                self._pending.setdefault(entry, data)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """معالجة المستخدمين بالتوازي مع الحفاظ على ترتيب تحديثات كل مستخدم"""
+    # التحديث المنتظر خلف تحديث لنفس المستخدم لا يشغل مكاناً من حد التوازي
+
+    def __init__(self, max_concurrent_updates, max_pending_updates=1024):
+        # حد الفئة الأساسية يشمل التحديثات المنتظرة، أما حد التنفيذ الفعلي فهو _slots
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.concurrency = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # المفتاح ← [قفل المستخدم، عدد التحديثات المنتظرة أو الجارية له]
+        self._chains = {}
+
+    @staticmethod
+    def ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.ordering_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        chain = self._chains.setdefault(key, [asyncio.Lock(), 0])
+        chain[1] += 1
+        try:
+            async with chain[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            chain[1] -= 1
+            if not chain[1]:
+                del self._chains[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    """استقبال التحديثات من Telegram ووضعها في طابور التطبيق"""
+
+    def initialize(self, bot_app, secret_token, draining):
+        self.bot_app = bot_app
+        self.secret_token = secret_token
+        self.draining = draining
+
+    async def post(self):
+        if self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            raise tornado.web.HTTPError(403)
+        if self.draining.is_set():
+            # يعيد Telegram إرسال التحديث لاحقاً إلى النسخة الجديدة
+            raise tornado.web.HTTPError(503)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_app.bot)
+        except (ValueError, TypeError) as e:
+            logger.error(f"تحديث غير صالح من الـ webhook: {e}")
+            raise tornado.web.HTTPError(400)
+        await self.bot_app.update_queue.put(update)
+
+def log_http_request(handler):
+    # طلبات التحديثات وفحص الصحة كثيرة فلا يُسجل منها إلا ما فشل
+    if handler.get_status() >= 400:
+        logger.warning(f"طلب HTTP مرفوض: {handler.get_status()} {handler.request.method} {handler.request.path}")
+
+class HealthHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_app, draining):
+        self.bot_app = bot_app
+        self.draining = draining
+
+    def get(self):
+        healthy = self.bot_app.running and not self.draining.is_set()
+        self.set_status(200 if healthy else 503)
+        self.write({
+            'status': 'ok' if healthy else 'draining',
+            'pending_updates': self.bot_app.update_queue.qsize(),
+            'background_tasks': len(background_tasks),
+        })
+
+async def run_webhook(application: Application, webhook_url, port, secret_token, max_connections=40, path='/telegram'):
+    """تشغيل البوت بوضع webhook على خادم HTTP يضم أيضاً مسار /health"""
+    # نفس ترتيب run_polling، وعند الإيقاف يتوقف الاستقبال قبل تفريغ الطابور
+    draining = asyncio.Event()
+    stop_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_requested.set)
+
+    web_app = tornado.web.Application([
+        (path, TelegramWebhookHandler, {'bot_app': application, 'secret_token': secret_token, 'draining': draining}),
+        (r'/health', HealthHandler, {'bot_app': application, 'draining': draining}),
+        (r'/metrics', MetricsHandler),
+    ], log_function=log_http_request)
+    server = tornado.httpserver.HTTPServer(web_app, xheaders=True)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    server.listen(port)
+    await application.bot.set_webhook(
+        url=f"{webhook_url.rstrip('/')}{path}",
+        secret_token=secret_token,
+        max_connections=max_connections,
+        allowed_updates=Update.ALL_TYPES,
+    )
+    logger.info(f"🌐 وضع webhook يعمل على المنفذ {port}")
+
+    try:
+        await stop_requested.wait()
+    finally:
+        logger.info("⏳ إيقاف استقبال التحديثات ومعالجة ما تبقى في الطابور...")
+        draining.set()
+        server.stop()
+        await server.close_all_connections()
+        # stop يعالج التحديثات المتبقية في الطابور وينتظر المهام الجارية قبل أن يعود
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def build_application(token, base_url=None):
+    """بناء التطبيق مع كل المعالجات، و base_url يسمح بتوجيه الطلبات إلى خادم Bot API آخر"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(InstrumentedRequest(connection_pool_size=int(os.getenv('TELEGRAM_POOL_SIZE', 256))))
+        .concurrent_updates(PerUserUpdateProcessor(int(os.getenv('UPDATE_CONCURRENCY', 16))))
+        .persistence(SQLitePersistence(adb, update_interval=int(os.getenv('PERSISTENCE_INTERVAL', 30))))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
     
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_user_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
     application.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, handle_media))
     application.add_handler(CallbackQueryHandler(handle_callback))
     application.add_error_handler(error_handler)
+    return application
+
+def main():
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token:
+        raise ValueError("❌ لم يتم تعيين TELEGRAM_BOT_TOKEN")
+    
+    application = build_application(token)
     
     logger.info("🚀 بدء تشغيل البوت الكامل مع نظام الاشتراك الإجباري...")
-    application.run_polling()
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        asyncio.run(run_webhook(
+            application,
+            webhook_url,
+            port=int(os.getenv('PORT', 8080)),
+            # بدون سر ثابت يُنشأ سر جديد مع كل تشغيل ويُسجل عند Telegram مع الـ webhook
+            secret_token=os.getenv('WEBHOOK_SECRET') or uuid.uuid4().hex,
+            max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40)),
+            path=os.getenv('WEBHOOK_PATH', '/telegram'),
+        ))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()